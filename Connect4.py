@@ -1,16 +1,15 @@
-import cv2
-from cv2 import matchTemplate as cv2m
 import numpy as np
-from IPython.core.debugger import set_trace
-import torch.functional as F
 
 class Connect4:
-    def __init__(self, rows=6, columns=7, datatype="uint8"):
+    def __init__(self, rows=6, columns=7, n_in_a_row=4, datatype="uint8"):
         self.rows = rows
         self.columns = columns
+        self.n_in_a_row = n_in_a_row
         self.datatype = datatype
         self._create_legal_moves_pattern()
         self._create_actions()
+        self.lines, self.cell_lines = winning_lines(rows, columns, n_in_a_row)
+        self.zobrist = ZobristHash(rows, columns)
         
     def _create_legal_moves_pattern(self):
 #         self.legal_move_pattern = np.array([1 for i in range(self.rows)])
@@ -34,14 +33,19 @@ class Connect4:
     def _create_actions(self):
         self.actions = [i for i in range(self.rows*self.columns)]
 
-    def get_legal_actions(self, joint_states):
+    def get_legal_actions(self, joint_states, heights=None):
         assert len(joint_states) == 2
+        if heights is not None:
+            return legal_actions_from_heights(heights, self.rows)
+
+        import cv2
+
         board = joint_states[0] + joint_states[1]
         
         legal_moves = []
         
         for k in range(board.shape[1]):
-            match = cv2m(self.legal_move_pattern.astype(self.datatype), 
+            match = cv2.matchTemplate(self.legal_move_pattern.astype(self.datatype), 
                      board[:, k].astype(self.datatype), cv2.TM_SQDIFF)
             
             i, j = np.where(match==0)
@@ -51,7 +55,7 @@ class Connect4:
 
         return legal_moves
 
-    def transition_and_evaluate(self, full_state, action):
+    def transition_and_evaluate(self, full_state, action, heights=None, boards=None):
         orig_player = int(full_state[2][0][0])
 
         plane = full_state[orig_player]
@@ -63,18 +67,17 @@ class Connect4:
         j = j[0]
         
         plane[i][j] = 1
+        if heights is not None:
+            heights[j] += 1
 
         new_player = (orig_player+1)%2
         full_state[2] = new_player
-        #right diag and up down are working
-        #left right is working
-        # assert full_state[orig_player][i][j] == 1
-        game_over = check_win(plane, i, j)
+        game_over = self.check_win(plane, idx)
 
         if game_over:
             result = 1
         else:
-            legal_actions = self.get_legal_actions(full_state[:2])
+            legal_actions = self.get_legal_actions(full_state[:2], heights)
             if len(legal_actions) == 0:
                 result = 0
                 game_over = True
@@ -83,6 +86,387 @@ class Connect4:
 
         return full_state, result, game_over
 
+    def check_win(self, plane, action):
+        # only the lines through the cell that was just played can be new
+        cells = plane.ravel()[self.lines[self.cell_lines[action]]]
+        return bool(cells.all(axis=1).any())
+
+
+class BitboardConnect4:
+    """Connect-N with one integer bitboard per player.
+
+    Same interface as Connect4 (actions, get_legal_actions and
+    transition_and_evaluate on the (3, rows, columns) numpy state), so it can
+    be handed to MetaQP or MCTSnet directly. Each column takes rows+1 bits
+    with the bottom row in the lowest bit, the extra bit being a sentinel that
+    keeps shifted lines from wrapping into the next column. A 6x7 board fits
+    in one 64-bit word; bigger boards use Python's arbitrary size ints.
+
+    Without boards every call rebuilds the bitboard it needs from the numpy
+    planes (about a fifth of a transition on 6x7). A caller holding a
+    BitboardConnect4 can carry the per-player bitboards from get_boards
+    next to the state, like the heights, and pass them in to skip that;
+    transition_and_evaluate updates them in place.
+    """
+    def __init__(self, rows=6, columns=7, n_in_a_row=4):
+        self.rows = rows
+        self.columns = columns
+        self.n_in_a_row = n_in_a_row
+        self.height = rows + 1
+        self._create_masks()
+        self._create_actions()
+        self.zobrist = ZobristHash(rows, columns)
+
+    def _create_masks(self):
+        i, j = np.indices((self.rows, self.columns))
+        self.cell_bits = (j * self.height + (self.rows - 1 - i)).flatten()
+        # float64 dot products are exact while every bit is below 2**53,
+        # past that the plane is packed into bytes instead
+        self.num_bits = self.height * self.columns
+        self.bit_weights = None
+        if self.num_bits <= 53:
+            self.bit_weights = 2.0 ** self.cell_bits
+
+        self.bottom_mask = 0
+        for c in range(self.columns):
+            self.bottom_mask |= 1 << (c * self.height)
+        self.board_mask = self.bottom_mask * ((1 << self.rows) - 1)
+
+        self.bit_to_action = {
+            1 << int(bit): action for action, bit in enumerate(self.cell_bits)}
+        self.action_bits = [1 << int(bit) for bit in self.cell_bits]
+
+    def _create_actions(self):
+        self.actions = [i for i in range(self.rows*self.columns)]
+
+    def get_bitboard(self, plane):
+        if self.bit_weights is None:
+            bits = np.zeros(self.num_bits, dtype=bool)
+            bits[self.cell_bits] = plane.ravel() != 0
+            return int.from_bytes(np.packbits(bits, bitorder="little").tobytes(), "little")
+        return int(np.dot(plane.ravel(), self.bit_weights))
+
+    def get_boards(self, full_state):
+        # [player 0, player 1] bitboards, a list so transitions update it in place
+        return [self.get_bitboard(full_state[0]), self.get_bitboard(full_state[1])]
+
+    def free_bits(self, mask):
+        # adding the bottom row carries into the lowest empty cell of
+        # every column, i.e. the top free bit each column is tracking
+        return (mask + self.bottom_mask) & self.board_mask
+
+    def get_legal_actions(self, joint_states, heights=None, boards=None):
+        assert len(joint_states) == 2
+        if heights is not None:
+            return legal_actions_from_heights(heights, self.rows)
+
+        if boards is not None:
+            mask = boards[0] | boards[1]
+        else:
+            mask = self.get_bitboard(joint_states[0]) | \
+                self.get_bitboard(joint_states[1])
+
+        free = self.free_bits(mask)
+
+        legal_moves = []
+        while free:
+            bit = free & -free
+            legal_moves.append(self.bit_to_action[bit])
+            free ^= bit
+
+        return legal_moves
+
+    def transition_and_evaluate(self, full_state, action, heights=None, boards=None):
+        orig_player = int(full_state[2][0][0])
+        new_player = (orig_player+1)%2
+
+        plane = full_state[orig_player]
+
+        i, j = divmod(int(action), self.columns)
+        plane[i][j] = 1
+        if heights is not None:
+            heights[j] += 1
+
+        full_state[2] = new_player
+
+        if boards is not None:
+            boards[orig_player] |= self.action_bits[action]
+            bitboard = boards[orig_player]
+        else:
+            bitboard = self.get_bitboard(plane)
+        game_over = check_win_bitboard(bitboard, self.height, self.n_in_a_row)
+
+        if game_over:
+            result = 1
+        else:
+            if heights is not None:
+                board_full = min(heights) == self.rows
+            else:
+                if boards is not None:
+                    mask = bitboard | boards[new_player]
+                else:
+                    mask = bitboard | self.get_bitboard(full_state[new_player])
+                board_full = self.free_bits(mask) == 0
+            if board_full:
+                result = 0
+                game_over = True
+            else:
+                result = None
+
+        return full_state, result, game_over
+
+
+class BatchedConnect4:
+    """Steps a whole (B, 3, rows, columns) batch of Connect-N games at once.
+
+    Same state layout and reward convention as Connect4.transition_and_evaluate,
+    but the piece is placed with a column-height gather and wins are found by
+    reducing the batch over the winning lines through the cells just played.
+    """
+    def __init__(self, rows=6, columns=7, n_in_a_row=4):
+        self.rows = rows
+        self.columns = columns
+        self.n_in_a_row = n_in_a_row
+        self._create_actions()
+        self.lines, self.cell_lines = winning_lines(rows, columns, n_in_a_row)
+        self.zobrist = ZobristHash(rows, columns)
+
+    def _create_actions(self):
+        self.actions = [i for i in range(self.rows*self.columns)]
+
+    def get_heights(self, states):
+        # number of pieces in every column, shape (B, columns)
+        return (states[:, 0] + states[:, 1]).sum(axis=1).astype("int64")
+
+    def get_legal_mask(self, states, heights=None):
+        """Boolean (B, rows*columns) mask of the legal actions of every game."""
+        if heights is None:
+            heights = self.get_heights(states)
+        batch, columns = np.nonzero(heights < self.rows)
+
+        mask = np.zeros((len(states), self.rows*self.columns), dtype=bool)
+        mask[batch, (self.rows - 1 - heights[batch, columns])*self.columns + columns] = True
+
+        return mask
+
+    def step(self, states, actions, active=None, heights=None, hashes=None):
+        """Plays actions[k] in game active[k] (every game if active is None).
+
+        states, and the (B, columns) heights and the Zobrist hashes when
+        they are tracked, are updated in place. hashes is either (B,) or
+        the (B, 2) pairs of ZobristHash.hash_pairs. Returns states with the
+        rewards and done flags of the stepped games, in the order of active.
+        """
+        if active is None:
+            active = np.arange(len(states))
+        active = np.asarray(active, dtype="int64")
+        columns = np.asarray(actions, dtype="int64") % self.columns
+
+        players = states[active, 2, 0, 0].astype("int64")
+        if heights is None:
+            active_heights = self.get_heights(states[active])
+        else:
+            active_heights = heights[active]
+        rows = self.rows - 1 - active_heights[np.arange(len(active)), columns]
+
+        states[active, players, rows, columns] = 1
+        states[active, 2] = (1 - players)[:, None, None]
+
+        if hashes is not None:
+            update = self.zobrist.update_batch if hashes.ndim == 1 else self.zobrist.update_pairs
+            hashes[active] = update(hashes[active], players, rows*self.columns + columns)
+
+        planes = states[active, players].reshape(len(active), -1)
+        won = self.lines_complete(planes, rows*self.columns + columns)
+
+        if heights is None:
+            full = (states[active, 0, 0] + states[active, 1, 0]).all(axis=1)
+        else:
+            heights[active, columns] += 1
+            full = (heights[active] == self.rows).all(axis=1)
+
+        rewards = won.astype("float32")
+        done = won | full
+
+        return states, rewards, done
+
+    def lines_complete(self, planes, cells=None):
+        """Whether each flattened plane has a full line, optionally only
+        looking at the lines through cells[k] for plane k."""
+        if cells is None:
+            return planes[:, self.lines].all(axis=2).any(axis=1)
+
+        lines = self.lines[self.cell_lines[cells]]
+        line_cells = np.take_along_axis(
+            planes, lines.reshape(len(planes), -1), axis=1)
+
+        return line_cells.reshape(lines.shape).all(axis=2).any(axis=1)
+
+    def games_over(self, states, actions=None, heights=None):
+        """Which games just ended, as (won, done) over the batch.
+
+        won is whether the player who just moved completed a line; passing
+        the actions that were just played restricts the check to the lines
+        through those cells.
+        """
+        movers = 1 - states[:, 2, 0, 0].astype("int64")
+        planes = states[np.arange(len(states)), movers].reshape(len(states), -1)
+        won = self.lines_complete(planes, actions)
+
+        if heights is None:
+            full = (states[:, 0, 0] + states[:, 1, 0]).all(axis=1)
+        else:
+            full = (heights == self.rows).all(axis=1)
+
+        return won, won | full
+
+
+def legal_actions_from_heights(heights, rows):
+    # the lowest empty cell of every column that still has room
+    columns = len(heights)
+    return [(rows - 1 - int(h))*columns + k for k, h in enumerate(heights) if h < rows]
+
+
+def mirror_states(states):
+    # left-right mirror of a state or a batch of states
+    return states[..., ::-1]
+
+
+def mirror_actions(rows, columns):
+    """Index that maps a flattened policy onto its left-right mirror."""
+    return np.arange(rows*columns).reshape(rows, columns)[:, ::-1].flatten()
+
+
+def canonicalize_batch(states):
+    """Picks one representative of every (state, mirror) pair.
+
+    Returns the canonical states and a flag per state saying whether it was
+    mirrored to get there. The canonical form is whichever of the two is
+    lexicographically larger, so a position and its mirror always map to
+    the same array.
+    """
+    flat = states.reshape(len(states), -1)
+    mirrored = mirror_states(states).reshape(len(states), -1)
+
+    differs = flat != mirrored
+    first = np.argmax(differs, axis=1)
+    batch = np.arange(len(states))
+    flipped = differs[batch, first] & (mirrored[batch, first] > flat[batch, first])
+
+    canonical = np.where(flipped[:, None, None, None], mirror_states(states), states)
+
+    return canonical, flipped
+
+
+def canonicalize(full_state):
+    canonical, flipped = canonicalize_batch(np.expand_dims(full_state, 0))
+    return canonical[0], bool(flipped[0])
+
+
+def winning_lines(rows, columns, n_in_a_row=4):
+    """Precomputed winning lines of a rows x columns board.
+
+    Returns lines, the flat cell indices of every n_in_a_row line with shape
+    (num_lines, n_in_a_row), and cell_lines, the indices into lines of every
+    line through each cell with shape (rows*columns, max_lines_per_cell).
+    Cells on fewer lines repeat their first line as padding, which leaves
+    any() reductions unchanged.
+    """
+    lines = []
+    for di, dj in ((1, 0), (0, 1), (1, 1), (1, -1)):
+        for i in range(rows):
+            for j in range(columns):
+                end_i = i + di * (n_in_a_row - 1)
+                end_j = j + dj * (n_in_a_row - 1)
+                if 0 <= end_i < rows and 0 <= end_j < columns:
+                    lines.append([(i + di * k) * columns + j + dj * k
+                                  for k in range(n_in_a_row)])
+    lines = np.array(lines, dtype="int64")
+
+    through_cell = [np.flatnonzero((lines == cell).any(axis=1))
+                    for cell in range(rows*columns)]
+    max_lines = max(len(line_idx) for line_idx in through_cell)
+
+    cell_lines = np.zeros((rows*columns, max_lines), dtype="int64")
+    for cell, line_idx in enumerate(through_cell):
+        cell_lines[cell] = line_idx[0]
+        cell_lines[cell, :len(line_idx)] = line_idx
+
+    return lines, cell_lines
+
+
+class ZobristHash:
+    """Zobrist keys for (3, rows, columns) Connect4 states.
+
+    A position hashes to the XOR of one random key per (player, cell) piece,
+    plus player_key when player 1 is to move, so a transition only has to
+    XOR in the new piece and flip the side to move. Keys come from a fixed
+    seed so every process and engine agrees on them.
+
+    Self-play carries (B, 2) hash pairs, the hash of every state and of its
+    left-right mirror, so the canonical form of a position can be picked
+    without looking at the board (see SymmetricQP).
+    """
+    def __init__(self, rows=6, columns=7, seed=0):
+        rng = np.random.RandomState(seed)
+        keys = rng.randint(1, 2**63 - 1, size=(2*rows*columns + 1,), dtype="int64")
+
+        self.keys = keys[:-1].reshape(2, rows*columns).astype("uint64")
+        self.player_key = np.uint64(keys[-1])
+        # a piece on cell a of the mirror sits on mirror_actions[a] of the state
+        self.pair_keys = np.stack(
+            [self.keys, self.keys[:, mirror_actions(rows, columns)]], axis=-1)
+
+        # python ints keep the single-state path free of numpy scalars
+        self.key_list = [[int(key) for key in player_keys] for player_keys in self.keys]
+        self.player_key_int = int(self.player_key)
+
+    def hash(self, full_state):
+        pieces = full_state[:2].reshape(2, -1) != 0
+        hashed = int(np.bitwise_xor.reduce(self.keys[pieces]))
+        if int(full_state[2][0][0]) == 1:
+            hashed ^= self.player_key_int
+        return hashed
+
+    def update(self, hashed, player, action):
+        return hashed ^ self.key_list[player][action] ^ self.player_key_int
+
+    def hash_batch(self, states):
+        pieces = states[:, :2].reshape(len(states), 2, -1) != 0
+        hashes = np.bitwise_xor.reduce(
+            np.where(pieces, self.keys, np.uint64(0)).reshape(len(states), -1), axis=1)
+        players = states[:, 2, 0, 0] == 1
+        hashes[players] ^= self.player_key
+        return hashes
+
+    def update_batch(self, hashes, players, actions):
+        return hashes ^ self.keys[players, actions] ^ self.player_key
+
+    def hash_pairs(self, states):
+        """(B, 2) hashes of the states and of their left-right mirrors."""
+        return np.stack([self.hash_batch(states), self.hash_batch(mirror_states(states))],
+                        axis=1)
+
+    def update_pairs(self, pairs, players, actions):
+        # pairs is (B, 2) with players and actions (B,), or one (2,) pair
+        return pairs ^ self.pair_keys[players, actions] ^ self.player_key
+
+
+def check_win_bitboard(bitboard, height, n_in_a_row=4):
+    # up-down, left-right and the two diagonals
+    for shift in (1, height, height - 1, height + 1):
+        # runs keeps the start bits of every run of `length` pieces,
+        # doubling the length each step until it reaches n_in_a_row
+        runs = bitboard
+        length = 1
+        while length < n_in_a_row:
+            step = min(length, n_in_a_row - length)
+            runs &= runs >> (shift * step)
+            length += step
+        if runs:
+            return True
+    return False
+
 #### Static testing functions
 # def test_transition():
 #     connect4 = Connect4()
@@ -170,42 +554,228 @@ def test_win_checkers():
     right_down_diag_win[3][3] = 0
     assert not check_win(right_down_diag_win, 0, 0)
 
-def check_win(state, i, j):
+def test_bitboard_matches_check_win():
+    connect4 = BitboardConnect4()
+    np.random.seed(0)
+
+    for _ in range(200):
+        state = np.zeros((3, 6, 7), dtype="float32")
+        game_over = False
+        while not game_over:
+            legal_actions = connect4.get_legal_actions(state[:2])
+            for action in legal_actions:
+                i, j = divmod(action, 7)
+                assert state[0][i][j] == 0 and state[1][i][j] == 0
+                assert i == 5 or state[0][i+1][j] + state[1][i+1][j] == 1
+
+            action = np.random.choice(legal_actions)
+            player = int(state[2][0][0])
+            state, result, game_over = connect4.transition_and_evaluate(
+                state, action)
+
+            i, j = divmod(action, 7)
+            assert (result == 1) == check_win(state[player], i, j)
+
+def test_line_table_check_win():
+    connect4 = Connect4()
+    np.random.seed(0)
+
+    lines, cell_lines = winning_lines(6, 7)
+    assert len(lines) == 69
+    for cell in range(42):
+        assert (lines[cell_lines[cell]] == cell).any(axis=1).all()
+
+    for _ in range(2000):
+        plane = (np.random.rand(6, 7) < .5).astype("float32")
+        i, j = np.random.randint(6), np.random.randint(7)
+        plane[i][j] = 0
+        # check_win assumes there was no line before (i, j) was played
+        if plane.ravel()[lines].all(axis=1).any():
+            continue
+        plane[i][j] = 1
+        assert connect4.check_win(plane, i*7 + j) == check_win(plane, i, j)
+
+def test_zobrist_incremental_matches_full_hash():
+    connect4 = BitboardConnect4()
+    batched = BatchedConnect4()
+    zobrist = batched.zobrist
+    np.random.seed(0)
+
+    states = np.zeros((40, 3, 6, 7), dtype="float32")
+    states[::2, 2] = 1
+    hashes = zobrist.hash_batch(states)
+    scalar_hashes = [zobrist.hash(state) for state in states]
+    assert list(hashes) == scalar_hashes
+    assert len(set(scalar_hashes)) == 2
+
+    done = np.zeros(len(states), dtype=bool)
+    while not done.all():
+        active = np.flatnonzero(~done)
+        actions = [np.random.choice(connect4.get_legal_actions(states[k][:2]))
+                   for k in active]
+        for k, action in zip(active, actions):
+            player = int(states[k][2][0][0])
+            scalar_hashes[k] = zobrist.update(scalar_hashes[k], player, action)
+
+        _, _, game_over = batched.step(states, actions, active, hashes=hashes)
+
+        assert (hashes == zobrist.hash_batch(states)).all()
+        assert list(hashes) == scalar_hashes
+        done[active[game_over]] = True
+
+def test_canonicalize_mirror_pairs():
+    connect4 = BitboardConnect4()
+    np.random.seed(0)
+
+    state = np.zeros((3, 6, 7), dtype="float32")
+    canonical, flipped = canonicalize(state)
+    assert (canonical == state).all() and not flipped
+
+    for _ in range(500):
+        legal_actions = connect4.get_legal_actions(state[:2])
+        state, _, game_over = connect4.transition_and_evaluate(
+            state, np.random.choice(legal_actions))
+        if game_over:
+            state = np.zeros((3, 6, 7), dtype="float32")
+
+        mirrored = np.copy(mirror_states(state))
+        canonical, flipped = canonicalize(state)
+        mirrored_canonical, mirrored_flipped = canonicalize(mirrored)
+
+        assert (canonical == mirrored_canonical).all()
+        if (state != mirrored).any():
+            assert flipped != mirrored_flipped
+        expected = mirrored if flipped else state
+        assert (canonical == expected).all()
+
+    index = mirror_actions(6, 7)
+    assert (index[index] == np.arange(42)).all()
+    assert index[35] == 41 and index[3] == 3
+
+def test_batched_step_matches_bitboard():
+    connect4 = BitboardConnect4()
+    batched = BatchedConnect4()
+    np.random.seed(0)
+
+    assert len(batched.lines) == 69
+
+    states = np.zeros((100, 3, 6, 7), dtype="float32")
+    states[::2, 2] = 1
+    expected = np.copy(states)
+    done = np.zeros(len(states), dtype=bool)
+
+    heights = batched.get_heights(states)
+    expected_heights = np.copy(heights)
+
+    while not done.all():
+        active = np.flatnonzero(~done)
+        actions = [np.random.choice(connect4.get_legal_actions(states[k][:2]))
+                   for k in active]
+
+        states, rewards, game_over = batched.step(states, actions, active, heights)
+
+        for k, action, reward, over in zip(active, actions, rewards, game_over):
+            _, result, expected_over = connect4.transition_and_evaluate(
+                expected[k], action, expected_heights[k])
+            assert over == expected_over
+            assert reward == (result == 1)
+
+        assert (states == expected).all()
+        assert (heights == expected_heights).all()
+        assert (heights == batched.get_heights(states)).all()
+
+        won, over = batched.games_over(states[active], np.asarray(actions))
+        assert (won == rewards.astype(bool)).all() and (over == game_over).all()
+        won, over = batched.games_over(states[active], heights=heights[active])
+        assert (won == rewards.astype(bool)).all() and (over == game_over).all()
+        done[active[game_over]] = True
+
+def test_connect_n_engines_agree():
+    np.random.seed(0)
+
+    for rows, columns, n_in_a_row in ((6, 7, 4), (7, 9, 5), (9, 11, 5), (5, 5, 3)):
+        connect4 = Connect4(rows, columns, n_in_a_row)
+        bitboard = BitboardConnect4(rows, columns, n_in_a_row)
+        batched = BatchedConnect4(rows, columns, n_in_a_row)
+
+        states = np.zeros((20, 3, rows, columns), dtype="float32")
+        heights = batched.get_heights(states)
+        done = np.zeros(len(states), dtype=bool)
+
+        while not done.all():
+            active = np.flatnonzero(~done)
+            actions = [np.random.choice(bitboard.get_legal_actions(states[k][:2]))
+                       for k in active]
+
+            for k, action in zip(active, actions):
+                player = int(states[k][2][0][0])
+                expected = np.copy(states[k])
+                _, result, over = bitboard.transition_and_evaluate(expected, action)
+                i, j = divmod(action, columns)
+                assert (result == 1) == connect4.check_win(expected[player], action)
+                assert (result == 1) == check_win(expected[player], i, j, n_in_a_row)
+
+            _, rewards, game_over = batched.step(states, actions, active, heights)
+
+            for k, action, reward, over in zip(active, actions, rewards, game_over):
+                assert reward == connect4.check_win(states[k][1 - int(states[k][2][0][0])], action)
+
+            done[active[game_over]] = True
+
+def test_legal_mask_matches_legal_actions():
+    connect4 = BitboardConnect4()
+    batched = BatchedConnect4()
+    np.random.seed(0)
+
+    states = np.zeros((50, 3, 6, 7), dtype="float32")
+    for _ in range(30):
+        mask = batched.get_legal_mask(states)
+        assert (mask == batched.get_legal_mask(states, batched.get_heights(states))).all()
+        for state, legal in zip(states, mask):
+            assert list(np.flatnonzero(legal)) == sorted(connect4.get_legal_actions(state[:2]))
+            assert list(np.flatnonzero(legal)) == sorted(connect4.get_legal_actions(
+                state[:2], batched.get_heights(state[None])[0]))
+
+        active = np.flatnonzero(mask.any(axis=1))
+        actions = [np.random.choice(np.flatnonzero(mask[k])) for k in active]
+        batched.step(states, actions, active)
+
+def check_win(state, i, j, n_in_a_row=4):
     done = False
-    done = check_up_down(state, i, j)
+    done = check_up_down(state, i, j, n_in_a_row)
     if done:
         return done
-    done = check_left_right(state, i, j)
+    done = check_left_right(state, i, j, n_in_a_row)
     if done:
         return done
-    done = check_right_diag(state, i, j)
+    done = check_right_diag(state, i, j, n_in_a_row)
     if done:
         return done
-    return check_left_diag(state, i, j)
+    return check_left_diag(state, i, j, n_in_a_row)
 
-def check_up_down(state, i, j):
+def check_up_down(state, i, j, n_in_a_row=4):
     num_in_a_row = 0
     for r in range(state.shape[0]):
         if state[r, j] == 0:
             num_in_a_row = 0
         else:
             num_in_a_row += 1
-            if num_in_a_row == 4:
+            if num_in_a_row == n_in_a_row:
                 return True
     return False
 
-def check_left_right(state, i, j):
+def check_left_right(state, i, j, n_in_a_row=4):
     num_in_a_row = 0
     for c in range(state.shape[1]):
         if state[i, c] == 0:
             num_in_a_row = 0
         else:
             num_in_a_row += 1
-            if num_in_a_row == 4:
+            if num_in_a_row == n_in_a_row:
                 return True
     return False
 
-def check_right_diag(state, i, j):
+def check_right_diag(state, i, j, n_in_a_row=4):
     r = i
     c = j
     while r < state.shape[0]-1 and c > 0:
@@ -221,7 +791,7 @@ def check_right_diag(state, i, j):
                 num_in_a_row = 0
             else:
                 num_in_a_row += 1
-                if num_in_a_row == 4:
+                if num_in_a_row == n_in_a_row:
                     return True
             r -= 1
     else:
@@ -233,14 +803,14 @@ def check_right_diag(state, i, j):
                 num_in_a_row = 0
             else:
                 num_in_a_row += 1
-                if num_in_a_row == 4:
+                if num_in_a_row == n_in_a_row:
                     return True 
                 
             c += 1
             
     return False
 
-def check_left_diag(state, i, j):
+def check_left_diag(state, i, j, n_in_a_row=4):
     r = i
     c = j
     while r > 0 and c > 0:
@@ -256,7 +826,7 @@ def check_left_diag(state, i, j):
                 num_in_a_row = 0
             else:
                 num_in_a_row += 1
-                if num_in_a_row == 4:
+                if num_in_a_row == n_in_a_row:
                     return True
             r += 1
     else:
@@ -268,7 +838,7 @@ def check_left_diag(state, i, j):
                 num_in_a_row = 0
             else:
                 num_in_a_row += 1
-                if num_in_a_row == 4:
+                if num_in_a_row == n_in_a_row:
                     return True 
                 
             c += 1
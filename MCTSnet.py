@@ -1,24 +1,19 @@
 from model_utils import eval_mode, setup_models, setup_optims, cast_to_torch, cast_to_cuda, cast_to_variable, train_mode
 from models import SoftmaxModule
 from utils import IOStream, create_folders
+from inference import inference_mode
 import numpy as np
 import torch
-from tqdm import tqdm
 import torch.nn.functional as F
-import matplotlib.pyplot as plt
 from torch.autograd import Variable
-from torch.autograd import gradcheck
 
 from copy import copy
 
-from IPython.core.debugger import set_trace
 import config
 
 import random
 from random import shuffle
 
-import hashlib
-
 import pickle
 import sys
 
@@ -31,6 +26,7 @@ class MCTSnet:
                  calculate_reward,
                  get_legal_actions,
                  transition,
+                 get_legal_mask=None,
                  version=0,
                  load_model=True,
                  load_memories=False,
@@ -51,6 +47,8 @@ class MCTSnet:
         self.get_legal_actions = get_legal_actions
         self.calculate_reward = calculate_reward
         self.transition = transition
+        # optional batched legal moves, states -> (B, len(actions)) bool mask
+        self.get_legal_mask = get_legal_mask
 
         self.best = best
 
@@ -83,6 +81,7 @@ class MCTSnet:
                                     self.calculate_reward,
                                     self.get_legal_actions,
                                     self.transition,
+                                    self.get_legal_mask,
                                     self.version,
                                     self.load_model,
                                     self.load_memories,
@@ -136,8 +135,9 @@ class MCTSnet:
                 idx = legal_actions[row]
                 action = self.actions[idx]
             else:
-                pi, _ = self.run_simulations(
-                    joint, curr_player, 0)
+                with inference_mode():
+                    pi, _ = self.run_simulations(
+                        joint, curr_player, 0)
 
                 print(pi)
 
@@ -216,6 +216,8 @@ class MCTSnet:
 
     def self_play(self, root_state, curr_player=0, save_model=True,
                   T=config.TAU, record_memories=True):
+        from tqdm import tqdm
+
         # Consider separating the network evaluation from the games, since
         # the network evaluation will be through deterministic games
         # So we want a stochastic policy since it will see more states and be more robust
@@ -232,7 +234,13 @@ class MCTSnet:
         np.set_printoptions(precision=3)
 
         for _ in tqdm(range(config.EPISODES)):
-            self.do_round(results, joint_state, curr_player, T=T, record_memories=record_memories)
+            if record_memories:
+                self.do_round(results, joint_state, curr_player, T=T)
+            else:
+                # evaluation games are never trained on
+                with inference_mode():
+                    self.do_round(results, joint_state, curr_player,
+                                  T=T, record_memories=False)
 
         # results["player_one"] = 0
         # results["player_two"] = 0
@@ -288,6 +296,8 @@ class MCTSnet:
         pickle.dump(self.memories, open("checkpoints/memories.p", "wb"))
 
     def plot_losses(self):
+        import matplotlib.pyplot as plt
+
         plt.plot(self.history["readout"], "r")
         plt.plot(self.history["policy"], "m")
         plt.plot(self.history["value"], "c")
@@ -295,6 +305,8 @@ class MCTSnet:
         plt.show()
 
     def run_simulations(self, joint_states, curr_player, turn):
+        from IPython.core.debugger import set_trace
+
         self.embeddings = dict()
         S = dict()
         A = dict()
@@ -486,25 +498,33 @@ class MCTSnet:
 
         return H
 
-    def correct_policy(self, logits, joint_state, is_root):
+    def legal_mask(self, joint_states):
+        if self.get_legal_mask is not None:
+            return self.get_legal_mask(joint_states)
+
+        mask = np.zeros((len(joint_states), len(self.actions)), dtype=bool)
+        for i, joint_state in enumerate(joint_states):
+            mask[i, self.get_legal_actions(joint_state[:2])] = True
+        return mask
+
+    def correct_policies(self, logits, joint_states, is_root):
         odds = np.exp(logits.data.numpy())
-        policy = odds / np.sum(odds)
+        policies = odds / np.sum(odds, axis=1, keepdims=True)
         if is_root:
-            nu = np.random.dirichlet([config.ALPHA] * len(self.actions))
-            policy = policy * (1 - config.EPSILON) + nu * config.EPSILON
+            # one dirichlet draw per row, normalised gamma samples
+            nu = np.random.gamma(config.ALPHA, size=policies.shape)
+            nu /= np.sum(nu, axis=1, keepdims=True)
+            policies = policies * (1 - config.EPSILON) + nu * config.EPSILON
 
-        mask = np.zeros(policy.shape)
-        legal_actions = self.get_legal_actions(joint_state[:2])
-        mask[legal_actions] = 1
-        policy = policy * mask
+        policies = policies * self.legal_mask(joint_states)
 
-        pol_sum = (np.sum(policy) * 1.0)
-        if pol_sum == 0:
-            return policy
-        else:
-            return policy / pol_sum
+        pol_sums = np.sum(policies, axis=1, keepdims=True)
 
-        return policy
+        return np.divide(policies, pol_sums, out=policies, where=pol_sums != 0)
+
+    def correct_policy(self, logits, joint_state, is_root):
+        joint_states = np.expand_dims(np.array(joint_state), 0)
+        return self.correct_policies(logits.unsqueeze(0), joint_states, is_root)[0]
 
     def zero_grad(self):
         for _, optim in self.optims.items():
@@ -528,6 +548,8 @@ class MCTSnet:
         # layer_opt = self.get_layer_opt
 
     def train(self, minibatches, last_loop=False):
+        from IPython.core.debugger import set_trace
+
         for e in range(config.EPOCHS):
             last_epoch = (e == (config.EPOCHS-1))
             if e > 0:
@@ -654,6 +676,8 @@ class MCTSnet:
                 pickle.dump(self.history, open("checkpoints/history.p", "wb"))
 
     def train_memories(self):
+        from tqdm import tqdm
+
         train_mode(self.models)
         self.io.cprint("Training memories")
 
@@ -1,6 +1,4 @@
 from models import QP
-from tqdm import tqdm
-import matplotlib.pyplot as plt
 import torch
 from torch import optim
 from torch.autograd import Variable
@@ -8,12 +6,15 @@ import torch.nn.functional as F
 from copy import copy
 from random import shuffle, sample
 import numpy as np
-from IPython.core.debugger import set_trace
 
 import config
 import utils
 import model_utils
+from inference import SymmetricQP, DualQP, CachedQP, InferenceCache, InferenceSession, model_pool
+from Connect4 import ZobristHash
+from rollout_buffer import RolloutBuffer
 from copy import deepcopy
+from itertools import count
 
 np.seterr(all="raise")
 
@@ -23,6 +24,8 @@ class MetaQP:
                  actions,
                  get_legal_actions,
                  transition_and_evaluate,
+                 step=None,
+                 get_legal_mask=None,
                  cuda=torch.cuda.is_available(),
                  best=False):
         utils.create_folders()
@@ -35,6 +38,32 @@ class MetaQP:
         self.actions = actions
         self.get_legal_actions = get_legal_actions
         self.transition_and_evaluate = transition_and_evaluate
+        # optional batched env step, (states, actions, active) -> (states, rewards, done),
+        # updating the heights and Zobrist hashes it is given in place
+        self.step = step
+        # optional batched legal moves, states -> (B, len(actions)) bool mask
+        self.get_legal_mask = get_legal_mask
+        # action sampling, seeded from the global numpy state so
+        # np.random.seed still makes self-play reproducible
+        self.rng = np.random.default_rng(np.random.randint(2**32))
+        self.rollout_buffer = RolloutBuffer()
+        self.rollout_horizon = config.ROLLOUT_HORIZON
+        # None, "qp" or "best", see self_play_qp
+        self.self_play_model = config.SELF_PLAY_MODEL
+        # one worker per model, see DualQP
+        self.model_pool = model_pool()
+        # the weights of "qp" and "best" get a new version whenever they are
+        # trained or loaded, see weights_changed
+        self.version_counter = count()
+        self.versions = {"qp": next(self.version_counter), "best": next(self.version_counter)}
+        # traced batchnorm-folded or int8 copies of the models by version,
+        # see compiled_model
+        self.compiled_inference = config.COMPILED_INFERENCE
+        self.quantized_inference = config.QUANTIZED_INFERENCE
+        self.compiled_models = {}
+        # positions already evaluated, keyed by (zobrist hash, version)
+        self.inference_cache = InferenceCache(config.INFERENCE_CACHE_SIZE)
+        self.zobrist = ZobristHash(config.R, config.C)
 
         if not best:
             self.q_optim, self.p_optim = model_utils.setup_optims(self.qp)
@@ -42,32 +71,189 @@ class MetaQP:
 
             if self.cuda:
                 self.best_qp = self.best_qp.cuda()
+            elif self.compiled_inference:
+                self.load_compiled_best()
 
             self.history = utils.load_history()
             self.memories = utils.load_memories()
 
-    def correct_policy(self, policy, state, mask=True):
-        if mask:
-            legal_actions = self.get_legal_actions(state[:2])
-
-            mask = np.zeros((len(self.actions),))
-            mask[legal_actions] = 1
-
-            policy = policy * mask
-
-        pol_sum = (np.sum(policy * 1.0))
-
-        if pol_sum == 0:
-            pass
-        else:
-            policy = policy / pol_sum
-
-        return policy
-
-    def correct_policies(self, policies, states):
-        for i, (policy, state) in enumerate(zip(policies, states)):
-            policies[i] = self.correct_policy(policy, state)
-        return policies
+    def get_heights(self, states):
+        # pieces per column, carried next to the states and updated by
+        # the env on every transition so legality never rescans the board
+        return np.sum(states[:, 0] + states[:, 1], axis=1).astype("int64")
+
+    def get_hashes(self, states):
+        # Zobrist hashes of the states and their mirrors, carried next to
+        # the heights and updated move by move for SymmetricQP and CachedQP
+        return self.zobrist.hash_pairs(states)
+
+    def legal_mask(self, states, heights):
+        if self.get_legal_mask is not None:
+            return self.get_legal_mask(states, heights)
+
+        mask = np.zeros((len(states), len(self.actions)), dtype=bool)
+        for i, state in enumerate(states):
+            mask[i, self.get_legal_actions(state[:2], heights[i])] = True
+        return mask
+
+    def correct_policies(self, policies, states, heights, out=None):
+        # masked to the legal moves and renormalised, into out when given
+        # (policies itself is fine); the mask is still built per call
+        mask = self.legal_mask(states, heights)
+        policies = np.multiply(policies, mask, out=out)
+
+        pol_sums = np.sum(policies, axis=1, keepdims=True)
+        # no mass left on any legal move, e.g. a softmax that underflowed:
+        # fall back to uniform over the legal moves
+        empty = pol_sums[:, 0] == 0
+        if empty.any():
+            policies[empty] = mask[empty]
+            pol_sums[empty] = np.sum(mask[empty], axis=1, keepdims=True)
+
+        return np.divide(policies, pol_sums, out=policies, where=pol_sums != 0)
+
+    def weights_changed(self, name):
+        """Gives the weights of "qp" or "best" a new version, dropping the
+        compiled copy of the old ones; their cache entries just age out."""
+        self.compiled_models.pop(self.versions[name], None)
+        self.versions[name] = next(self.version_counter)
+
+    def model_version(self, qp):
+        # qp is self.qp or self.best_qp, or an actor's RemoteQP for one
+        return self.versions["qp" if qp is self.qp else "best"]
+
+    def load_compiled_best(self):
+        # the export saved along with the best checkpoint, if there is one
+        from compiled import load_compiled
+
+        if self.quantized_inference:
+            return
+        compiled = load_compiled()
+        if compiled is not None:
+            self.compiled_models[self.versions["best"]] = compiled
+
+    def compiled_model(self, qp):
+        """The int8 copy of qp (with the traced one for small batches, see
+        QuantizedQP) when quantized inference is on, the traced,
+        batchnorm-folded one when compiled inference is, qp itself otherwise.
+
+        Copies are cached until the weights change, i.e. until the next
+        training pass or model reload.
+        """
+        if not (self.compiled_inference or self.quantized_inference):
+            return qp
+        if self.quantized_inference and self.cuda:
+            raise ValueError("Quantized inference runs on the CPU, "
+                             "turn off cuda or config.QUANTIZED_INFERENCE")
+        # the tracer, and torch.ao when quantizing, are only needed here
+        from compiled import compile_qp
+
+        version = self.model_version(qp)
+        if version not in self.compiled_models:
+            if self.quantized_inference:
+                from quantized import QuantizedQP, quantize_qp
+                compiled = QuantizedQP(quantize_qp(qp, self.calibration_states()),
+                                       compile_qp(qp))
+            else:
+                compiled = compile_qp(qp)
+            self.compiled_models[version] = compiled
+        return self.compiled_models[version]
+
+    def print_quantized_calls(self):
+        # how many forward calls the int8 copies took, the rest were too
+        # small and went to the float ones
+        calls = {"int8": 0, "float": 0}
+        for model in self.compiled_models.values():
+            for name in calls:
+                calls[name] += model.calls[name]
+                model.calls[name] = 0
+        print("Int8 calls: {} of {}".format(calls["int8"], calls["int8"] + calls["float"]))
+
+    def calibration_states(self, num_states=config.CALIBRATION_STATES):
+        # the latest recorded self-play states, random games before there are any
+        from quantized import memory_states
+
+        states = memory_states(self.memories[-num_states:])
+        if len(states):
+            return states
+
+        positions = []
+        while len(positions) < num_states:
+            state = np.zeros(config.SHAPE, dtype="float32")
+            state[2] = np.random.choice(2)
+            game_over = False
+            while not game_over and len(positions) < num_states:
+                positions.append(np.copy(state))
+                action = np.random.choice(self.get_legal_actions(state[:2]))
+                state, _, game_over = self.transition_and_evaluate(state, action)
+
+        return np.array(positions)
+
+    def cached_model(self, qp):
+        # the compiled model behind the inference cache, when there is one
+        # and qp does not keep its own (RemoteQP leaves it to the server)
+        version = self.model_version(qp)
+        qp = self.compiled_model(qp)
+        if config.INFERENCE_CACHE_SIZE and getattr(qp, "cacheable", True):
+            qp = CachedQP(qp, self.inference_cache, version, self.zobrist)
+        return qp
+
+    def inference_model(self, qp):
+        qp = self.cached_model(qp)
+        # self-play only ever needs canonical states, see SymmetricQP
+        if config.CANONICAL_INFERENCE:
+            return SymmetricQP(qp)
+        return qp
+
+    def dual_model(self, best_player):
+        # every move is evaluated by the model playing it: best_qp plays
+        # best_player in all games, qp the other side
+        return DualQP(self.inference_model(self.qp), self.inference_model(self.best_qp),
+                      best_player, self.model_pool)
+
+    def self_play_qp(self, best_player):
+        # with a self-play model set that model plays both sides, as one
+        # full batch, and gating is left to run_evaluation
+        if self.self_play_model == "qp":
+            return self.inference_model(self.qp)
+        if self.self_play_model == "best":
+            return self.inference_model(self.best_qp)
+        return self.dual_model(best_player)
+
+    def inference_session(self, best_player):
+        # numpy in and out, no autograd, for everything but training
+        return InferenceSession(self.self_play_qp(best_player), self.cuda)
+
+    def candidate_policies(self, session, task_states, percent_random=.2, hashes=None):
+        """N_WAY noisy candidate policies for every task state.
+
+        The trunk and policy head run once per task state; the policy is
+        repeated N_WAY times before the noise is mixed in, so each candidate
+        still gets its own draw. Also returns the task embeddings repeated
+        to line up with the candidates, ready for qp.q.
+        """
+        index = np.repeat(np.arange(len(task_states)), config.N_WAY)
+
+        embedding = session.embed(task_states, hashes)
+        policy = session.policy(embedding)[index]
+
+        return self.add_policy_noise(policy, percent_random), session.select(embedding, index)
+
+    def add_policy_noise(self, policies, percent_random=.2):
+        # same mix as models.add_policy_noise, one draw per row
+        noise = np.random.uniform(size=policies.shape).astype("float32")
+        return policies * (1 - percent_random) + noise * percent_random
+
+    def sample_actions(self, policies):
+        # Gumbel-max draws one action per row in a single call: the argmax of
+        # log(p) + Gumbel noise is distributed according to p. A row without
+        # mass would silently give action 0, legal or not
+        assert np.all(np.sum(policies, axis=1) > 0), "policy without probability mass"
+        with np.errstate(divide="ignore"):
+            log_policies = np.log(policies)
+        noise = self.rng.gumbel(size=log_policies.shape)
+
+        return np.asarray(self.actions)[np.argmax(log_policies + noise, axis=1)]
 
     def wrap_to_variable(self, numpy_array, volatile=False):
         var = Variable(torch.from_numpy(
@@ -76,13 +262,19 @@ class MetaQP:
             var = var.cuda()
         return var
 
-    def transition_and_evaluate_minibatch(self, minibatch, policies, tasks, num_done, is_done,
-                                          bests_turn, best_starts, results):
+    def transition_and_evaluate_minibatch(self, minibatch, heights, hashes, policies, tasks,
+                                          num_done, is_done, best_player, results):
+        # heights and hashes are updated in place along with the minibatch; finished rows
+        # are never played, and a drawn one has no legal move left to sample
+        live = np.logical_not(is_done)
+        actions = np.zeros(len(policies), dtype="int64")
+        actions[live] = self.sample_actions(policies[live])
+
         task_idx = 0
         n_way_idx = 0
         #map non_done minibatch indices to a smaller tensor
         non_done_view = []
-        for i, (state, policy) in enumerate(zip(minibatch, policies)):
+        for i, (state, action) in enumerate(zip(minibatch, actions)):
             if i % config.N_WAY == 0 and i != 0:
                 task_idx += 1
             if i != 0:
@@ -92,12 +284,9 @@ class MetaQP:
             # this was causing this error
             # the flipping of is done is f'ing something up
             if not is_done[i]:  # and tasks[task_idx] is not None:
-                action = np.random.choice(self.actions, p=policy)
-
+                hashes[i] = self.zobrist.update_pairs(hashes[i], int(state[2][0][0]), action)
                 state, reward, game_over = self.transition_and_evaluate(
-                    state, action)
-
-                bests_turn = (bests_turn+1) % 2
+                    state, action, heights[i])
 
                 if game_over:
                     is_done[i] = True
@@ -108,21 +297,77 @@ class MetaQP:
                                 is_done[i+k] = True
                                 is_done[i] = False
                                 minibatch[i] = minibatch[i+k]
+                                heights[i] = heights[i+k]
+                                hashes[i] = hashes[i+k]
                                 break
-                        if bests_turn == best_starts:
+                        # the player who just moved made the last move
+                        winner = 1 - int(state[2][0][0])
+                        if reward == 0:
+                            results["draw"] += 1
+                        elif winner == best_player:
                             results["best"] += 1
                         else:
                             results["new"] += 1
                     else:
-                        starting_player = tasks[task_idx]["starting_player"]
-                        curr_player = int(state[2][0][0])
-                        if starting_player != curr_player:
-                            reward *= -1
-                        tasks[task_idx]["memories"][n_way_idx]["result"] = reward
+                        tasks[task_idx]["memories"][n_way_idx]["result"] = self.rollout_result(
+                            reward, state, tasks[task_idx]["starting_player"])
                 else:
                     non_done_view.extend([i])
 
-        return minibatch, tasks, num_done, is_done, results, bests_turn, non_done_view
+        return minibatch, tasks, num_done, is_done, results, non_done_view
+
+    def rollout_result(self, value, state, starting_player):
+        """The result stored for a rollout that reached state, from value,
+        the outcome for the side that just moved into state.
+
+        A finished rollout passes its reward; a truncated one passes minus
+        the Q of state, as Q is from the point of view of the side to move.
+        """
+        if starting_player != int(state[2][0][0]):
+            value *= -1
+        return value
+
+    def bootstrap(self, tasks, states, qs, rows):
+        """Stores the (n, 1) Q estimates qs of the unfinished rollouts in
+        minibatch rows rows, now at states, as their results."""
+        for state, q, row in zip(states, qs[:, 0], rows):
+            task_idx, n_way_idx = divmod(int(row), config.N_WAY)
+            tasks[task_idx]["memories"][n_way_idx]["result"] = self.rollout_result(
+                -float(q), state, tasks[task_idx]["starting_player"])
+
+    def rollout(self, tasks, best_player):
+        """Plays the candidate games in the rollout buffer out to the end,
+        or to the rollout horizon, and stores each result in its task
+        memory."""
+        # rollout games are independent of each other, so all of the
+        # games still running are stepped with a single batched call
+        buffer = self.rollout_buffer
+        session = self.inference_session(best_player)
+
+        plies = 0
+        while True:
+            states, heights, hashes, policies, rows = buffer.live()
+            actions = self.sample_actions(policies)
+            _, rewards, game_over = self.step(states, actions, heights=heights, hashes=hashes)
+
+            for slot in np.flatnonzero(game_over):
+                task_idx, n_way_idx = divmod(int(rows[slot]), config.N_WAY)
+                tasks[task_idx]["memories"][n_way_idx]["result"] = self.rollout_result(
+                    int(rewards[slot]), states[slot], tasks[task_idx]["starting_player"])
+
+            buffer.remove(game_over)
+            if len(buffer) == 0:
+                break
+            plies += 1
+
+            # the live prefix of the buffer goes to torch without a copy
+            states, heights, hashes, live_policies, rows = buffer.live()
+            embedding = session.embed(states, hashes)
+            self.correct_policies(session.policy(embedding), states, heights, out=live_policies)
+
+            if self.rollout_horizon is not None and plies >= self.rollout_horizon:
+                self.bootstrap(tasks, states, session.q(embedding, live_policies), rows)
+                break
 
     def get_states_from_next_minibatch(self, next_minibatch):
         states = []
@@ -132,10 +377,10 @@ class MetaQP:
 
         return states
 
-    def setup_tasks(self, states, starting_player_list, episode_is_done):
+    def setup_tasks(self, states, heights, hashes, starting_player_list, episode_is_done):
         tasks = []
         minibatch = np.zeros((config.EPISODE_BATCH_SIZE,
-                              config.CH, config.R, config.C))
+                              config.CH, config.R, config.C), dtype="float32")
         idx = 0
         for task_idx in range(config.EPISODE_BATCH_SIZE // config.N_WAY):
             if not episode_is_done[idx]:
@@ -152,9 +397,31 @@ class MetaQP:
                 minibatch[idx] = np.array(states[task_idx])
                 idx += 1
 
-        return minibatch, tasks
+        minibatch_heights = np.repeat(heights, config.N_WAY, axis=0)
+        minibatch_hashes = np.repeat(hashes, config.N_WAY, axis=0)
+
+        return minibatch, minibatch_heights, minibatch_hashes, tasks
 
     def run_episode(self, orig_states):
+        results = self.play_episode(orig_states)
+        self.end_episode(results, orig_states)
+
+    def run_actors(self, orig_states, num_actors=config.NUM_ACTORS):
+        # the episode is played by num_actors forked processes while this
+        # process answers their forward passes in batches
+        from actors import play_episodes
+
+        results = play_episodes(self, orig_states, num_actors)
+        self.end_episode(results, orig_states)
+
+    def run_async(self, orig_state, num_games=config.EPISODE_BATCH_SIZE):
+        # games run as coroutines and advance independently of each other
+        from scheduler import play_async
+
+        results = play_async(self, orig_state, num_games)
+        self.end_episode(results, orig_state)
+
+    def play_episode(self, orig_states):
         np.set_printoptions(precision=3)
         results = {
             "new": 0, "best": 0, "draw": 0
@@ -166,7 +433,8 @@ class MetaQP:
 
         episode_num_done = 0
 
-        best_starts = np.random.choice(2)
+        # the side best_qp plays in every game of the episode
+        best_player = np.random.choice(2)
 
         starting_player_list = [np.random.choice(2) for _ in range(
             config.EPISODE_BATCH_SIZE//config.N_WAY)]
@@ -183,171 +451,288 @@ class MetaQP:
                 new_states.extend([new_state])
             states = new_states
 
-        bests_turn = best_starts
+        heights = self.get_heights(np.array(states))
+        hashes = self.get_hashes(np.array(states))
+
         while episode_num_done < config.EPISODE_BATCH_SIZE:
             print("Num done {}".format(episode_num_done))
-            states, episode_is_done, episode_num_done, results = self.meta_self_play(states=states,
+            states, heights, hashes, episode_is_done, episode_num_done, results = self.meta_self_play(states=states,
+                                                                                     heights=heights,
+                                                                                     hashes=hashes,
                                                                                      episode_is_done=episode_is_done,
                                                                                      episode_num_done=episode_num_done,
                                                                                      results=results,
-                                                                                     bests_turn=bests_turn,
-                                                                                     best_starts=best_starts,
+                                                                                     best_player=best_player,
                                                                                      starting_player_list=starting_player_list)
-            bests_turn = (bests_turn+1) % 2
 
+        return results
+
+    def run_stream(self, orig_state, num_games=config.EPISODE_BATCH_SIZE):
+        results = self.play_stream(orig_state, num_games)
+        self.end_episode(results, orig_state)
+
+    def play_stream(self, orig_state, num_games=config.EPISODE_BATCH_SIZE):
+        """Self-play that keeps the minibatch full.
+
+        Like run_episode, but as soon as all N_WAY rows of a task slot are
+        done the slot is restarted from orig_state with a new starting
+        player, instead of idling until the slowest task finishes. Task
+        memories are appended to self.memories every move as before. Stops
+        once num_games games have finished and returns their results.
+        """
+        np.set_printoptions(precision=3)
+        results = {
+            "new": 0, "best": 0, "draw": 0
+        }
+        num_tasks = config.EPISODE_BATCH_SIZE // config.N_WAY
+        # the side best_qp plays in every game of the episode
+        best_player = np.random.choice(2)
+
+        starting_player_list = [np.random.choice(2) for _ in range(num_tasks)]
+        states = []
+        for starting_player in starting_player_list:
+            new_state = np.array(orig_state)
+            new_state[2] = starting_player
+            states.extend([new_state])
+        heights = self.get_heights(np.array(states))
+        hashes = self.get_hashes(np.array(states))
+        root_heights = self.get_heights(np.array([orig_state]))[0]
+
+        episode_is_done = [False] * config.EPISODE_BATCH_SIZE
+        episode_num_done = 0
+        games_done = 0
+
+        while games_done < num_games:
+            print("Games done {}".format(games_done))
+            num_done = episode_num_done
+            states, heights, hashes, episode_is_done, episode_num_done, results = self.meta_self_play(states=states,
+                                                                                     heights=heights,
+                                                                                     hashes=hashes,
+                                                                                     episode_is_done=episode_is_done,
+                                                                                     episode_num_done=episode_num_done,
+                                                                                     results=results,
+                                                                                     best_player=best_player,
+                                                                                     starting_player_list=starting_player_list)
+            games_done += episode_num_done - num_done
+
+            for task_idx in range(num_tasks):
+                rows = slice(task_idx*config.N_WAY, (task_idx+1)*config.N_WAY)
+                if all(episode_is_done[rows]):
+                    starting_player_list[task_idx] = np.random.choice(2)
+                    states[task_idx] = np.array(orig_state)
+                    states[task_idx][2] = starting_player_list[task_idx]
+                    heights[task_idx] = root_heights
+                    hashes[task_idx] = self.get_hashes(states[task_idx][None])[0]
+                    episode_is_done[rows] = [False] * config.N_WAY
+                    episode_num_done -= config.N_WAY
+
+        return results
+
+    def gate(self, root_state, results=None):
+        """"promote", "revert" or None for qp against best_qp.
+
+        Without SPRT gating this is the threshold on results, or on one
+        batch of evaluation games from root_state when there are none.
+
+        The SPRT needs one result per independent game, which the N_WAY
+        rows of a self-play task are not, so with SPRT gating results are
+        ignored. Evaluation games are played in chunks of
+        config.EVALUATION_BATCH_SIZE until the test is decided or
+        config.SPRT_MAX_GAMES games have been played; an undecided test
+        falls back to the threshold on all of them.
+        """
+        from evaluation import Evaluator
+        from gating import SPRT, threshold_decision
+
+        root_state = np.asarray(root_state)
+        if root_state.ndim == 4:
+            # an episode started from several states, open from the first
+            root_state = root_state[0]
+        evaluator = Evaluator(self)
+
+        if not config.SPRT_GATING:
+            if results is None:
+                results = evaluator.play(root_state)
+                print("Evaluation results: ", results)
+            return threshold_decision(results)
+
+        sprt = SPRT()
+        while sprt.decision() is None and sprt.games() < config.SPRT_MAX_GAMES:
+            sprt.update(evaluator.play(root_state))
+        print("SPRT: {} after {} games, LLR {:.2f} in ({:.2f}, {:.2f})".format(
+            sprt.decision(), sprt.games(), sprt.llr(), sprt.lower, sprt.upper))
+
+        return sprt.decision() or threshold_decision(sprt.results)
+
+    def run_evaluation(self, orig_state):
+        # gates qp against best_qp on deterministic evaluation games only
+        self.apply_decision(self.gate(orig_state))
+
+    def end_episode(self, results, orig_state):
+        print("Results: ", results)
+        decision = None
+        if self.self_play_model is None:
+            decision = self.gate(orig_state, results)
+        if config.INFERENCE_CACHE_SIZE:
+            print("Inference cache hit rate: {:.1%}".format(self.inference_cache.hit_rate()))
+            self.inference_cache.reset_stats()
+        if self.quantized_inference:
+            self.print_quantized_calls()
+        # gating games add memories too
         if len(self.memories) > config.MAX_TASK_MEMORIES:
             self.memories[-config.MAX_TASK_MEMORIES:]
         utils.save_memories(self.memories)
-        print("Results: ", results)
-        if results["new"] > results["best"] * config.SCORING_THRESHOLD:
+        self.apply_decision(decision)
+
+    def apply_decision(self, decision):
+        if decision == "promote":
             model_utils.save_model(self.qp)
             print("Loading new best model")
+            self.weights_changed("best")
             self.best_qp = model_utils.load_model()
             if self.cuda:
                 self.best_qp = self.best_qp.cuda()
-        elif results["best"] > results["new"] * config.SCORING_THRESHOLD:
+            elif self.compiled_inference:
+                self.load_compiled_best()
+        elif decision == "revert":
             print("Reverting to previous best")
+            self.weights_changed("qp")
             self.qp = model_utils.load_model()
             if self.cuda:
                 self.qp = self.qp.cuda()
             self.q_optim, self.p_optim = model_utils.setup_optims(self.qp)
 
-    def meta_self_play(self, states, episode_is_done, episode_num_done, bests_turn,
-                       results, best_starts, starting_player_list):
+    def meta_self_play(self, states, heights, hashes, episode_is_done, episode_num_done, results,
+                       best_player, starting_player_list):
         self.qp.eval()
         self.best_qp.eval()
-        minibatch, tasks = self.setup_tasks(
+        minibatch, minibatch_heights, minibatch_hashes, tasks = self.setup_tasks(
             states=states,
+            heights=heights,
+            hashes=hashes,
             starting_player_list=starting_player_list,
             episode_is_done=episode_is_done)
 
-        minibatch_variable = self.wrap_to_variable(minibatch)
-
-        if bests_turn == 1:
-            qp = self.best_qp
-        else:
-            qp = self.qp
-
-        _, policies = qp(minibatch_variable, percent_random=.2)
+        qp = self.inference_session(best_player)
 
-        policies = policies.detach().data.numpy()
+        policies, embedding = self.candidate_policies(
+            qp, minibatch[::config.N_WAY], percent_random=.2,
+            hashes=minibatch_hashes[::config.N_WAY])
 
-        corrected_policies = self.correct_policies(policies, minibatch)
+        corrected_policies = self.correct_policies(policies, minibatch, minibatch_heights,
+                                                   out=policies)
 
         # corrected_policies_copy = np.array(corrected_policies)
 
-        policies_input = self.wrap_to_variable(corrected_policies)
+        qs = qp.q(embedding, corrected_policies)
 
-        qs, _ = qp(minibatch_variable, policies_input)
-
-        qs = qs.detach().data.numpy()
-
-        idx = 0
-        for task_idx in range(config.EPISODE_BATCH_SIZE // config.N_WAY):
-            for _ in range(config.N_WAY):
-                #if tasks[task_idx] is not None:
-                if not episode_is_done[idx]:
-                    tasks[task_idx]["memories"].extend(
-                        [{"policy": corrected_policies[idx]}])
-                elif tasks[task_idx] is not None:
-                    tasks[task_idx]["memories"].extend([None])
-                idx += 1
+        # finished games are packed at the end of their task, so a task is
+        # None exactly when all of its rows are done
+        for task_idx, task in enumerate(tasks):
+            if task is not None:
+                rows = range(task_idx*config.N_WAY, (task_idx+1)*config.N_WAY)
+                task["memories"].extend([None if episode_is_done[idx] else
+                                         {"policy": corrected_policies[idx]} for idx in rows])
 
+        # (tasks, N_WAY, R*C): each task's improved policy is the Q weighted
+        # sum of its candidates, masked and renormalised
         scaled_qs = (qs + 1) / 2
-        weighted_policies = corrected_policies * scaled_qs
-
-        idx = 0
-        for task_idx in range(config.EPISODE_BATCH_SIZE // config.N_WAY):
-            summed_policy = 0
-            for _ in range(config.N_WAY):
-                summed_policy += weighted_policies[idx]
-                idx += 1
-            idx -= config.N_WAY
+        weighted_policies = (corrected_policies * scaled_qs).reshape(
+            -1, config.N_WAY, len(self.actions))
+        improved_policies = self.correct_policies(
+            weighted_policies.sum(axis=1), minibatch[::config.N_WAY],
+            minibatch_heights[::config.N_WAY])
 
-            improved_policy = self.correct_policy(
-                summed_policy, minibatch[idx], mask=True)
-
-            if tasks[task_idx] is not None:
-                tasks[task_idx]["improved_policy"] = improved_policy
-            for _ in range(config.N_WAY):
-                weighted_policies[idx] = improved_policy
-                idx += 1
+        for task, improved_policy in zip(tasks, improved_policies):
+            if task is not None:
+                task["improved_policy"] = improved_policy
 
         is_done = deepcopy(episode_is_done)
         num_done = episode_num_done
 
-        improved_policies = weighted_policies
+        improved_policies = np.repeat(improved_policies, config.N_WAY, axis=0)
+
+        next_minibatch_heights = np.array(minibatch_heights)
+        next_minibatch_hashes = np.array(minibatch_hashes)
 
         next_minibatch, tasks, \
             episode_num_done, episode_is_done, \
-            results, bests_turn, non_done_view = self.transition_and_evaluate_minibatch(minibatch=np.array(minibatch),
+            results, non_done_view = self.transition_and_evaluate_minibatch(minibatch=np.array(minibatch),
+                                                                         heights=next_minibatch_heights,
+                                                                         hashes=next_minibatch_hashes,
                                                                          policies=improved_policies,
                                                                          tasks=tasks,
                                                                          num_done=episode_num_done,
                                                                          is_done=episode_is_done,
-                                                                         bests_turn=bests_turn,
-                                                                         best_starts=best_starts,
+                                                                         best_player=best_player,
                                                                          results=results)
 
         next_states = self.get_states_from_next_minibatch(next_minibatch)
-        # revert back to orig turn now that we are done
-        bests_turn = (bests_turn+1) % 2
-
-        policies = corrected_policies
+        next_heights = next_minibatch_heights[::config.N_WAY]
+        next_hashes = next_minibatch_hashes[::config.N_WAY]
 
-        while True:
-            minibatch, tasks, \
-                num_done, is_done, \
-                _, bests_turn, non_done_view = self.transition_and_evaluate_minibatch(minibatch=minibatch,
-                                                                    policies=policies,
-                                                                    tasks=tasks,
-                                                                    num_done=num_done,
-                                                                    is_done=is_done,
-                                                                    bests_turn=bests_turn,
-                                                                    best_starts=best_starts,
-                                                                    results=None)
-
-            if num_done == config.EPISODE_BATCH_SIZE:
-                break
-            
-            minibatch_view = minibatch[non_done_view]
-
-            minibatch_view_variable = self.wrap_to_variable(minibatch_view)
-
-            # when you fixed this use is_done to make a view of the minibatch_variable which will reduce the batch size going into
-            # pytorch when you have some that are done, i.e. removing redundancy. perhaps put it in transition and evaluate with an option
-
-            if bests_turn == 1:
-                qp = self.best_qp
-            else:
-                qp = self.qp
-
-            # Idea: since I am going through a trajectory of states, I could probably
-            # also learn a value function and have the Q value for the original policy
-            # be a combination of the V and the reward. so basically we could use the V
-            # function in a couple different ways. for the main moves we could use it
-            # to scale the policies according to the V values from the transitioned states,
-            # i.e. for each of the transitioned states from the improved policies, we
-            # look at the V values from those, and scale the action probas according to those
-            # so basically we could rescale it to 0-1 and then multiply it with the policies
-            # and it should increase the probabilities for estimatedly good actions and
-            # decrease for bad ones
-
-            # for the inner loop Q estimation trajectories we could average together the V
-            # values for each of the states, i.e. we could have an additional target
-            # for the Q network, which is the averaged together V values from the trajectory
-            # that should provide a fairly good estimate of the Q value, and won't be
-            # as noisy as the result
-
-            # another possible improvement is making the policy noise learnable, i.e.
-            # the scale of the noise, and how much weight it has relative to the generated policy
-            _, policies_view = self.qp(minibatch_view_variable)
-
-            policies_view = policies_view.detach().data.numpy()
-
-            policies_view = self.correct_policies(policies_view, minibatch_view)
-
-            policies[non_done_view] = policies_view
+        if self.step is not None:
+            self.rollout_buffer.load(minibatch, minibatch_heights, minibatch_hashes,
+                                     corrected_policies, np.flatnonzero(np.logical_not(is_done)))
+            self.rollout(tasks, best_player)
+        else:
+            # envs without a batched step roll out one game at a time
+            policies = corrected_policies
+
+            plies = 0
+            while True:
+                minibatch, tasks, \
+                    num_done, is_done, \
+                    _, non_done_view = self.transition_and_evaluate_minibatch(minibatch=minibatch,
+                                                                        heights=minibatch_heights,
+                                                                        hashes=minibatch_hashes,
+                                                                        policies=policies,
+                                                                        tasks=tasks,
+                                                                        num_done=num_done,
+                                                                        is_done=is_done,
+                                                                        best_player=best_player,
+                                                                        results=None)
+
+                if num_done == config.EPISODE_BATCH_SIZE:
+                    break
+                plies += 1
+
+                minibatch_view = minibatch[non_done_view]
+
+                # when you fixed this use is_done to make a view of the minibatch_variable which will reduce the batch size going into
+                # pytorch when you have some that are done, i.e. removing redundancy. perhaps put it in transition and evaluate with an option
+
+                # Idea: since I am going through a trajectory of states, I could probably
+                # also learn a value function and have the Q value for the original policy
+                # be a combination of the V and the reward. so basically we could use the V
+                # function in a couple different ways. for the main moves we could use it
+                # to scale the policies according to the V values from the transitioned states,
+                # i.e. for each of the transitioned states from the improved policies, we
+                # look at the V values from those, and scale the action probas according to those
+                # so basically we could rescale it to 0-1 and then multiply it with the policies
+                # and it should increase the probabilities for estimatedly good actions and
+                # decrease for bad ones
+
+                # for the inner loop Q estimation trajectories we could average together the V
+                # values for each of the states, i.e. we could have an additional target
+                # for the Q network, which is the averaged together V values from the trajectory
+                # that should provide a fairly good estimate of the Q value, and won't be
+                # as noisy as the result
+
+                # another possible improvement is making the policy noise learnable, i.e.
+                # the scale of the noise, and how much weight it has relative to the generated policy
+                embedding = qp.embed(minibatch_view, minibatch_hashes[non_done_view])
+                policies_view = qp.policy(embedding)
+
+                policies_view = self.correct_policies(policies_view, minibatch_view,
+                                                      minibatch_heights[non_done_view])
+
+                policies[non_done_view] = policies_view
+
+                if self.rollout_horizon is not None and plies >= self.rollout_horizon:
+                    self.bootstrap(tasks, minibatch_view, qp.q(embedding, policies_view),
+                                   non_done_view)
+                    break
         fixed_tasks = []
         for _, task in enumerate(tasks):
             if task is not None:
@@ -361,9 +746,11 @@ class MetaQP:
 
         self.memories.extend(fixed_tasks)
 
-        return next_states, episode_is_done, episode_num_done, results
+        return next_states, next_heights, next_hashes, episode_is_done, episode_num_done, results
 
     def train_memories(self):
+        from tqdm import tqdm
+
         self.qp.train()
         self.qp.Q.train()
         self.qp.P.train()
@@ -388,6 +775,8 @@ class MetaQP:
             # ]
             self.train_tasks(minibatch)
 
+        self.weights_changed("qp")
+
         utils.save_history(self.history)
 
         # self.train_minibatches(minibatches)
@@ -503,11 +892,11 @@ class MetaQP:
             # set_trace()
 
             self.p_optim.step()
-            p_loss = policy_loss.data.numpy()[0]
-            q_loss = Q_loss.data.numpy()[0]
+            p_loss = policy_loss.data.view(-1).numpy()[0]
+            q_loss = Q_loss.data.view(-1).numpy()[0]
             self.history["q_loss"].extend([q_loss])
             self.history["p_loss"].extend([p_loss])
 
             if e == (config.EPOCHS-1):
-                print("Policy loss {}".format(policy_loss.data.numpy()[0]))
-                print("Q loss: {}".format(Q_loss.data.numpy()[0]))
+                print("Policy loss {}".format(policy_loss.data.view(-1).numpy()[0]))
+                print("Q loss: {}".format(Q_loss.data.view(-1).numpy()[0]))
@@ -0,0 +1,341 @@
+"""Self-play actors sharing one batched inference server.
+
+The process that calls play_episodes owns qp and best_qp and acts as the
+inference server. Every actor is a forked copy of the MetaQP instance whose
+models are replaced by RemoteQP proxies, so the env and task bookkeeping run
+unchanged in the actors while all forward passes go through the server.
+
+Each actor gets its own ActorChannel: shared-memory tensors for the states,
+policies, rows and Q values of one request, plus a response queue. The
+request queue, shared by all actors, only carries small Request tuples,
+where the kind says which outputs the actor needs. The server collects
+requests until every live actor is waiting or config.INFERENCE_SERVER_TIMEOUT
+passes, then runs one batch per model and kind. Whenever it times out it
+also checks that no actor has died, so a crashed actor fails the episode
+instead of leaving the server waiting.
+
+The server keeps the embeddings of each actor's latest POLICY request per
+model, so the Q requests that follow it (the candidates of a task, or a
+rollout's bootstrap) only send the rows they want and their policies and
+the trunk runs once per state. With the inference cache on, the server
+also holds the cache, shared by all actors.
+"""
+from collections import namedtuple
+import multiprocessing
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+import config
+from inference import InferenceSession
+
+# model name sent by an actor that has finished its episode
+DONE = None
+# request kinds: the policy alone, Q of given policies, or both; EMBEDDED_Q
+# asks for Q on rows of the embedding kept from the actor's last POLICY
+# request instead of sending the states again
+POLICY = "policy"
+Q = "q"
+EMBEDDED_Q = "embedded_q"
+FORWARD = "forward"
+
+# embedding is the id of the POLICY request whose embedding an EMBEDDED_Q
+# request uses, and the id of the request itself for a POLICY one
+Request = namedtuple("Request", ["actor_id", "model", "rows", "kind",
+                                 "percent_random", "embedding"])
+
+
+class ActorChannel:
+    def __init__(self, actor_id, requests, context):
+        self.actor_id = actor_id
+        self.requests = requests
+        self.responses = context.SimpleQueue()
+        self.states = torch.zeros(config.EPISODE_BATCH_SIZE,
+                                  config.CH, config.R, config.C).share_memory_()
+        self.policies = torch.zeros(config.EPISODE_BATCH_SIZE,
+                                    config.R*config.C).share_memory_()
+        self.Qs = torch.zeros(config.EPISODE_BATCH_SIZE, 1).share_memory_()
+        self.rows = torch.zeros(config.EPISODE_BATCH_SIZE, dtype=torch.int64).share_memory_()
+        # id of the last POLICY request per model, whose embedding the
+        # server holds
+        self.embedded = {}
+        self.num_requests = 0
+
+    def request(self, model, kind, state, policy=None, percent_random=None,
+                embedding=None, rows=None):
+        """(Q, policy) from the server, Q is None for a POLICY request and
+        policy is the given one for a Q request. An EMBEDDED_Q request
+        sends the id of the POLICY request whose embedding it uses and the
+        rows of it to evaluate instead of the states."""
+        self.num_requests += 1
+        if kind == EMBEDDED_Q:
+            self.rows[:len(rows)].copy_(rows.data)
+            rows = len(rows)
+        else:
+            rows = state.size()[0]
+            self.states[:rows].copy_(state.data)
+        if kind in (Q, EMBEDDED_Q):
+            self.policies[:rows].copy_(policy.data)
+        if kind == POLICY:
+            embedding = self.embedded[model] = self.num_requests
+
+        self.requests.put(Request(self.actor_id, model, rows, kind, percent_random, embedding))
+        self.responses.get()
+
+        # the buffers are reused by the next request
+        Qs = None
+        if kind != POLICY:
+            Qs = Variable(self.Qs[:rows].clone())
+        if kind not in (Q, EMBEDDED_Q):
+            policy = Variable(self.policies[:rows].clone())
+
+        return Qs, policy
+
+    def done(self):
+        self.requests.put(Request(self.actor_id, DONE, 0, None, None, None))
+
+
+class RemoteEmbedding:
+    """The states of an embedding that lives on the server.
+
+    request is the POLICY request that ran the states through the trunk, or
+    None before one has, and rows the rows of that request's states these
+    ones are, None for all of them.
+    """
+    def __init__(self, state, request=None, rows=None):
+        self.state = state
+        self.request = request
+        self.rows = rows
+
+
+class RemoteQP:
+    """Stands in for a QP inside an actor, forwarding to the server.
+
+    The embedding never leaves the server: embed only wraps the states and
+    policy sends them, after which the server keeps their embedding until
+    the actor's next POLICY request to the same model. q on such an
+    embedding, or on rows selected from it, sends just the rows and the
+    policies; the states are only sent again when the embedding is stale.
+    The server holds the inference cache, so CachedQP does not wrap this.
+    """
+    cacheable = False
+
+    def __init__(self, channel, model):
+        self.channel = channel
+        self.model = model
+
+    def eval(self):
+        return self
+
+    def __call__(self, state, policy=None, percent_random=None):
+        if policy is not None:
+            return self.channel.request(self.model, Q, state, policy)
+        return self.channel.request(self.model, FORWARD, state, percent_random=percent_random)
+
+    def embed(self, state):
+        return RemoteEmbedding(state)
+
+    def policy(self, embedding, percent_random=None):
+        policy = self.channel.request(self.model, POLICY, embedding.state,
+                                      percent_random=percent_random)[1]
+        embedding.request = self.channel.embedded[self.model]
+        embedding.rows = None
+        return policy
+
+    def select(self, embedding, index):
+        rows = index if embedding.rows is None else embedding.rows.index_select(0, index)
+        return RemoteEmbedding(embedding.state.index_select(0, index), embedding.request, rows)
+
+    def q(self, embedding, policy):
+        if embedding.request is None or embedding.request != self.channel.embedded.get(self.model):
+            return self.channel.request(self.model, Q, embedding.state, policy)[0]
+        rows = embedding.rows
+        if rows is None:
+            rows = torch.arange(embedding.state.size()[0])
+        return self.channel.request(self.model, EMBEDDED_Q, None, policy,
+                                    embedding=embedding.request, rows=rows)[0]
+
+
+class InferenceServer:
+    def __init__(self, models, channels, requests, cuda=False):
+        self.sessions = {name: InferenceSession(model, cuda) for name, model in models.items()}
+        self.channels = channels
+        self.requests = requests
+        self.batch_sizes = []
+        # (actor, model) -> (POLICY request id, policy batch, its embedding,
+        # first row of the actor's states in it) of the actor's last POLICY
+        # request to the model
+        self.embeddings = {}
+        self.num_policy_batches = 0
+
+    def serve(self, actors):
+        """Answers requests until every one of the actor processes is done.
+
+        Raises RuntimeError if an actor exits with an error, since it will
+        never send its DONE.
+        """
+        live = len(actors)
+        pending = []
+        while live > 0 or pending:
+            try:
+                request = self.requests.get(timeout=config.INFERENCE_SERVER_TIMEOUT)
+            except queue.Empty:
+                self.check_actors(actors)
+                self.run_batch(pending)
+                pending = []
+                continue
+
+            if request.model is DONE:
+                live -= 1
+                for model in self.sessions:
+                    self.embeddings.pop((request.actor_id, model), None)
+            else:
+                pending.append(request)
+
+            # actors wait for their answer, so nothing else can arrive
+            if pending and len(pending) == live:
+                self.run_batch(pending)
+                pending = []
+
+    def check_actors(self, actors):
+        for actor_id, actor in enumerate(actors):
+            if actor.exitcode not in (None, 0):
+                raise RuntimeError("Actor {} exited with code {} before finishing its "
+                                   "episode".format(actor_id, actor.exitcode))
+
+    def kept_embedding(self, request):
+        request_id, batch, embedding, start = self.embeddings[(request.actor_id, request.model)]
+        if request_id != request.embedding:
+            raise RuntimeError("Actor {} asked for the embedding of request {}, the server "
+                               "holds {}".format(request.actor_id, request.embedding, request_id))
+        return batch, embedding, start
+
+    def run_batch(self, pending):
+        groups = {}
+        for request in pending:
+            key = (request.model, request.kind, request.percent_random)
+            if request.kind == EMBEDDED_Q:
+                # rows of one policy batch's embedding are evaluated together
+                key += (self.kept_embedding(request)[0],)
+            groups.setdefault(key, []).append(request)
+
+        for (model, kind, percent_random, *_), requests in groups.items():
+            channels = [self.channels[request.actor_id] for request in requests]
+            sizes = [request.rows for request in requests]
+            session = self.sessions[model]
+            Qs = policies = None
+
+            if kind in (Q, EMBEDDED_Q):
+                policy = np.concatenate(
+                    [channel.policies.numpy()[:rows] for channel, rows in zip(channels, sizes)])
+
+            if kind == EMBEDDED_Q:
+                _, embedding, _ = self.kept_embedding(requests[0])
+                index = np.concatenate(
+                    [self.kept_embedding(request)[2] + channel.rows.numpy()[:rows]
+                     for request, channel, rows in zip(requests, channels, sizes)])
+                Qs = session.q(session.select(embedding, index), policy)
+            else:
+                # numpy views of the shared-memory buffers
+                state = np.concatenate(
+                    [channel.states.numpy()[:rows] for channel, rows in zip(channels, sizes)])
+                if kind == POLICY:
+                    embedding = session.embed(state)
+                    policies = session.policy(embedding, percent_random)
+                    self.keep_embeddings(requests, embedding)
+                elif kind == Q:
+                    Qs = session.q(session.embed(state), policy)
+                else:
+                    Qs, policies = session(state, None, percent_random)
+            self.batch_sizes.append(sum(sizes))
+
+            start = 0
+            for channel, rows in zip(channels, sizes):
+                if Qs is not None:
+                    channel.Qs.numpy()[:rows] = Qs[start:start+rows]
+                if policies is not None:
+                    channel.policies.numpy()[:rows] = policies[start:start+rows]
+                start += rows
+                channel.responses.put(True)
+
+    def keep_embeddings(self, requests, embedding):
+        # each actor's slot for the model now points into this batch, an
+        # older batch is freed once no slot points into it
+        batch = self.num_policy_batches
+        self.num_policy_batches += 1
+        start = 0
+        for request in requests:
+            self.embeddings[(request.actor_id, request.model)] = (
+                request.embedding, batch, embedding, start)
+            start += request.rows
+
+
+def run_actor(metaqp, channel, results, orig_states, seed):
+    # the server owns the cores for the forward passes
+    torch.set_num_threads(1)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    metaqp.rng = np.random.default_rng(seed)
+
+    metaqp.cuda = False
+    # the server runs the compiled models
+    metaqp.compiled_inference = False
+    metaqp.quantized_inference = False
+    # worker threads do not survive the fork, and a single worker keeps
+    # one request at a time on the channel
+    metaqp.model_pool = ThreadPoolExecutor(1)
+    metaqp.qp = RemoteQP(channel, "qp")
+    metaqp.best_qp = RemoteQP(channel, "best")
+    metaqp.memories = []
+
+    episode_results = metaqp.play_episode(orig_states)
+
+    results.put((metaqp.memories, episode_results))
+    channel.done()
+
+
+def play_episodes(metaqp, orig_states, num_actors=config.NUM_ACTORS):
+    """Plays one episode in each of num_actors processes.
+
+    Adds the actors' task memories to metaqp.memories and returns the summed
+    results, ready for metaqp.end_episode.
+    """
+    # fork so the actors share the already loaded env and models
+    context = multiprocessing.get_context("fork")
+    requests = context.Queue()
+    results = context.Queue()
+    channels = [ActorChannel(actor_id, requests, context) for actor_id in range(num_actors)]
+    seeds = np.random.randint(2**31, size=num_actors)
+
+    actors = [context.Process(target=run_actor,
+                              args=(metaqp, channel, results, orig_states, seed))
+              for channel, seed in zip(channels, seeds)]
+    for actor in actors:
+        actor.start()
+
+    server = InferenceServer({"qp": metaqp.cached_model(metaqp.qp),
+                              "best": metaqp.cached_model(metaqp.best_qp)},
+                             channels, requests, metaqp.cuda)
+    try:
+        server.serve(actors)
+    except RuntimeError:
+        for actor in actors:
+            actor.terminate()
+        raise
+
+    episode_results = {"new": 0, "best": 0, "draw": 0}
+    for _ in range(num_actors):
+        memories, actor_results = results.get()
+        metaqp.memories.extend(memories)
+        for key, value in actor_results.items():
+            episode_results[key] += value
+
+    for actor in actors:
+        actor.join()
+
+    print("Mean inference batch: {:.1f}".format(np.mean(server.batch_sizes)))
+
+    return episode_results
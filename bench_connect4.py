@@ -0,0 +1,77 @@
+from Connect4 import Connect4, BitboardConnect4, BatchedConnect4
+import numpy as np
+import timeit
+
+NUM_GAMES = 200
+REPEATS = 5
+
+
+def record_positions(connect4, num_games):
+    """Plays random games and records every (state, action) pair along the way."""
+    positions = []
+    for _ in range(num_games):
+        state = np.zeros((3, connect4.rows, connect4.columns), dtype="float32")
+        game_over = False
+        while not game_over:
+            action = np.random.choice(connect4.get_legal_actions(state[:2]))
+            positions.append((np.copy(state), action))
+            state, _, game_over = connect4.transition_and_evaluate(
+                state, action)
+
+    return positions
+
+
+def time_per_call(fn, positions):
+    total = min(timeit.repeat(lambda: [fn(state, action) for state, action in positions],
+                              number=1, repeat=REPEATS))
+    return total / len(positions) * 1e6
+
+
+def bench(name, connect4, positions):
+    states = [np.copy(state) for state, _ in positions]
+
+    def legal(state, _):
+        return connect4.get_legal_actions(state[:2])
+
+    def step(state, action):
+        return connect4.transition_and_evaluate(np.copy(state), action)
+
+    def copy_only(state, _):
+        return np.copy(state)
+
+    legal_us = time_per_call(legal, positions)
+    step_us = time_per_call(step, positions) - time_per_call(copy_only, positions)
+
+    print("{:<10} get_legal_actions {:8.2f} us   transition_and_evaluate {:8.2f} us".format(
+        name, legal_us, step_us))
+
+    return legal_us, step_us
+
+
+def bench_batched(connect4, batch_sizes=(1, 60, 1000, 5000)):
+    """Per-game cost of one BatchedConnect4.step over random mid-game batches."""
+    bitboard = BitboardConnect4()
+    for batch_size in batch_sizes:
+        positions = record_positions(bitboard, batch_size // 20 + 1)
+        chosen = np.random.choice(len(positions), batch_size)
+        states = np.array([positions[k][0] for k in chosen])
+        actions = np.array([positions[k][1] for k in chosen])
+
+        total = min(timeit.repeat(lambda: connect4.step(np.copy(states), actions),
+                                  number=1, repeat=REPEATS))
+        print("batched    step B={:<5} {:8.2f} us/game".format(
+            batch_size, total / batch_size * 1e6))
+
+
+if __name__ == "__main__":
+    np.random.seed(0)
+    positions = record_positions(BitboardConnect4(), NUM_GAMES)
+    print("{} positions from {} random games".format(len(positions), NUM_GAMES))
+
+    current = bench("numpy/cv2", Connect4(), positions)
+    bitboard = bench("bitboard", BitboardConnect4(), positions)
+
+    print("speedup    get_legal_actions {:8.1f}x   transition_and_evaluate {:8.1f}x".format(
+        current[0] / bitboard[0], current[1] / bitboard[1]))
+
+    bench_batched(BatchedConnect4())
@@ -0,0 +1,53 @@
+from Connect4 import BitboardConnect4, BatchedConnect4
+from bench_connect4 import record_positions, time_per_call
+import numpy as np
+import timeit
+
+NUM_GAMES = 50
+BATCH_SIZE = 1000
+REPEATS = 5
+
+BOARDS = [
+    (6, 7, 4),
+    (7, 9, 5),
+    (9, 11, 5),
+    (12, 14, 6),
+    (15, 17, 6),
+]
+
+
+def bench_board(rows, columns, n_in_a_row):
+    bitboard = BitboardConnect4(rows, columns, n_in_a_row)
+    batched = BatchedConnect4(rows, columns, n_in_a_row)
+
+    positions = record_positions(bitboard, NUM_GAMES)
+
+    def step(state, action):
+        return bitboard.transition_and_evaluate(np.copy(state), action)
+
+    def copy_only(state, _):
+        return np.copy(state)
+
+    step_us = time_per_call(step, positions) - time_per_call(copy_only, positions)
+
+    chosen = np.random.choice(len(positions), BATCH_SIZE)
+    states = np.array([positions[k][0] for k in chosen])
+    actions = np.array([positions[k][1] for k in chosen])
+    heights = batched.get_heights(states)
+
+    batched_total = min(timeit.repeat(
+        lambda: batched.step(np.copy(states), actions, heights=np.copy(heights)),
+        number=1, repeat=REPEATS))
+    batched_us = batched_total / BATCH_SIZE * 1e6
+
+    print("{:>2}x{:<2} connect-{}  lines {:5}  lines/cell {:3}  "
+          "bitboard {:6.2f} us/step   batched {:6.2f} us/game".format(
+              rows, columns, n_in_a_row, len(batched.lines),
+              batched.cell_lines.shape[1], step_us, batched_us))
+
+
+if __name__ == "__main__":
+    np.random.seed(0)
+    print("step cost as the board grows (batched at B={})".format(BATCH_SIZE))
+    for rows, columns, n_in_a_row in BOARDS:
+        bench_board(rows, columns, n_in_a_row)
@@ -0,0 +1,93 @@
+"""Rollout cost against result-target quality for different rollout horizons.
+
+    python bench_horizon.py
+    python bench_horizon.py --horizons 1 2 4 8 none --reference 64
+
+Takes one episode batch of candidate policies from mid-game positions and
+estimates the expected result of each candidate with the mean of
+--reference full rollouts. Then, for every horizon, it draws --repeats
+batches of single-rollout targets the way meta_self_play does, bootstrapping
+with Q past the horizon. It reports rollouts per second, plies stepped per
+rollout, and the squared error and bias of the targets against that
+reference. "none" plays every rollout to the end, so its error is the plain
+label noise of one rollout.
+"""
+import argparse
+import time
+
+import numpy as np
+
+import config
+from benchmarks import make_metaqp, record_positions, seed_everything
+from Connect4 import BitboardConnect4
+
+
+def candidate_batch(metaqp, best_player):
+    """(minibatch, heights, policies, starting players) of one episode batch
+    of candidate policies from positions of random games."""
+    num_tasks = config.EPISODE_BATCH_SIZE // config.N_WAY
+    positions = record_positions(BitboardConnect4(config.R, config.C, config.N_IN_A_ROW))
+    picks = np.random.choice(len(positions), num_tasks, replace=False)
+    task_states = np.array([positions[pick][0] for pick in picks])
+
+    minibatch = np.repeat(task_states, config.N_WAY, axis=0)
+    heights = metaqp.get_heights(minibatch)
+    hashes = metaqp.get_hashes(minibatch)
+    policies, _ = metaqp.candidate_policies(
+        metaqp.inference_session(best_player), task_states, percent_random=.2,
+        hashes=hashes[::config.N_WAY])
+    policies = metaqp.correct_policies(policies, minibatch, heights)
+
+    return minibatch, heights, hashes, policies, task_states[:, 2, 0, 0].astype("int64")
+
+
+def targets(metaqp, batch, best_player):
+    """One result target per candidate, as meta_self_play would store them."""
+    minibatch, heights, hashes, policies, starting_players = batch
+    tasks = [{"starting_player": int(starting_player),
+              "memories": [{} for _ in range(config.N_WAY)]}
+             for starting_player in starting_players]
+
+    metaqp.rollout_buffer.load(minibatch, heights, hashes, policies, np.arange(len(minibatch)))
+    metaqp.rollout(tasks, best_player)
+
+    return np.array([memory["result"] for task in tasks for memory in task["memories"]])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--horizons", nargs="+", default=["1", "2", "4", "8", "none"])
+    parser.add_argument("--reference", type=int, default=32,
+                        help="full rollouts averaged into the reference targets")
+    parser.add_argument("--repeats", type=int, default=8)
+    args = parser.parse_args()
+
+    metaqp, counter = make_metaqp()
+    seed_everything(metaqp=metaqp)
+    metaqp.qp.eval()
+    metaqp.best_qp.eval()
+    best_player = 0
+    batch = candidate_batch(metaqp, best_player)
+
+    metaqp.rollout_horizon = None
+    reference = np.mean([targets(metaqp, batch, best_player)
+                         for _ in range(args.reference)], axis=0)
+
+    print("{:>7} {:>11} {:>13} {:>11} {:>8}".format(
+        "horizon", "rollouts/s", "plies/rollout", "target MSE", "bias"))
+    for horizon in args.horizons:
+        metaqp.rollout_horizon = None if horizon == "none" else int(horizon)
+
+        counter["positions"] = 0
+        start = time.perf_counter()
+        draws = np.array([targets(metaqp, batch, best_player) for _ in range(args.repeats)])
+        elapsed = time.perf_counter() - start
+
+        rollouts = draws.size
+        print("{:>7} {:>11.1f} {:>13.2f} {:>11.4f} {:>+8.4f}".format(
+            horizon, rollouts / elapsed, counter["positions"] / rollouts,
+            np.mean((draws - reference) ** 2), np.mean(draws - reference)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Startup time of main.py up to its first run_episode call.
+
+    python bench_startup.py
+    python bench_startup.py --repeats 10
+
+Each repeat starts a fresh interpreter that runs main.py with
+MetaQP.run_episode (and the other self-play entry points) replaced by a
+hook that reports how long the process took to get there and exits.
+train_memories is skipped so only imports and setup are timed. The report
+also lists which optional heavy modules got imported; a headless worker
+should only need torch and numpy.
+
+The modules behind the optional self-play modes, gating and compiled
+inference are imported by the methods that use them, so the script exits
+non-zero if any of them is loaded by then. Standard library modules that
+torch imports by itself (it loads multiprocessing, asyncio and
+concurrent.futures) are not held against MetaQP.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+HEAVY_MODULES = ["cv2", "IPython", "matplotlib", "tqdm"]
+# only imported by the MetaQP methods that need them
+DEFERRED_MODULES = ["actors", "scheduler", "gating", "evaluation", "compiled", "quantized",
+                    "multiprocessing", "asyncio", "concurrent.futures"]
+
+CHILD = """
+import time
+start = time.perf_counter()
+import json, runpy, sys
+import torch
+torch_modules = sorted(sys.modules)
+import MetaQP
+
+def first_episode(self, *args, **kwargs):
+    print(json.dumps({
+        "seconds": time.perf_counter() - start,
+        "modules": sorted(sys.modules),
+        "torch_modules": torch_modules,
+    }))
+    sys.stdout.flush()
+    raise SystemExit(0)
+
+MetaQP.MetaQP.train_memories = lambda self: None
+MetaQP.MetaQP.run_episode = first_episode
+MetaQP.MetaQP.run_stream = first_episode
+MetaQP.MetaQP.run_actors = first_episode
+MetaQP.MetaQP.run_async = first_episode
+runpy.run_path("main.py", run_name="__main__")
+"""
+
+
+def run_once():
+    """Returns (process wall time, time to first run_episode, loaded modules,
+    modules loaded by importing torch alone)."""
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, "-c", CHILD])
+    wall = time.perf_counter() - start
+    report = json.loads(output.decode().strip().splitlines()[-1])
+
+    return wall, report["seconds"], report["modules"], report["torch_modules"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    walls, seconds = [], []
+    for _ in range(args.repeats):
+        wall, to_episode, modules, torch_modules = run_once()
+        walls.append(wall)
+        seconds.append(to_episode)
+
+    print("process wall time:       {:.3f}s (median of {})".format(
+        np.median(walls), args.repeats))
+    print("imports + setup in main: {:.3f}s".format(np.median(seconds)))
+    loaded = [name for name in HEAVY_MODULES if name in modules]
+    print("optional modules loaded: {}".format(", ".join(loaded) or "none"))
+
+    deferred = [name for name in DEFERRED_MODULES
+                if name in modules and name not in torch_modules]
+    if deferred:
+        raise SystemExit("Imported before the first episode: {}".format(", ".join(deferred)))
+
+
+if __name__ == "__main__":
+    main()
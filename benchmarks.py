@@ -0,0 +1,344 @@
+"""Micro-benchmarks for the env, inference and training hot paths.
+
+    python benchmarks.py --output before.json
+    python benchmarks.py --output after.json --compare before.json
+
+Every benchmark seeds numpy, torch and random, runs a warm-up pass and then
+reports the median of several timed repeats. Results are written as JSON so
+two runs can be diffed; --compare prints the change per benchmark and exits
+non-zero when anything regressed by more than --threshold.
+"""
+import argparse
+import json
+import platform
+import random
+import subprocess
+import time
+
+import numpy as np
+import torch
+
+import config
+from Connect4 import Connect4, BitboardConnect4, BatchedConnect4, check_win_bitboard
+from inference import InferenceSession
+
+SEED = 0
+WARMUP = 2
+REPEATS = 5
+NUM_GAMES = 100
+QP_BATCH_SIZES = [1, 10, 60, 120, 600]
+
+
+def seed_everything(seed=SEED, metaqp=None):
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    random.seed(seed)
+    if metaqp is not None:
+        metaqp.rng = np.random.default_rng(seed)
+
+
+def measure(fn, warmup=WARMUP, repeats=REPEATS):
+    """Median wall time of fn() in seconds after warmup untimed calls."""
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return float(np.median(times))
+
+
+def result(value, unit, higher_is_better=False):
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def record_positions(connect4, num_games=NUM_GAMES):
+    positions = []
+    for _ in range(num_games):
+        state = np.zeros(config.SHAPE, dtype="float32")
+        game_over = False
+        while not game_over:
+            action = np.random.choice(connect4.get_legal_actions(state[:2]))
+            positions.append((np.copy(state), action))
+            state, _, game_over = connect4.transition_and_evaluate(state, action)
+
+    return positions
+
+
+def bench_env():
+    seed_everything()
+    results = {}
+    positions = record_positions(BitboardConnect4(config.R, config.C, config.N_IN_A_ROW))
+    states = [np.copy(state) for state, _ in positions]
+    after = []
+    for state, action in positions:
+        next_state = np.copy(state)
+        player = int(state[2][0][0])
+        next_state[player].flat[action] = 1
+        after.append((next_state[player], action))
+
+    engines = [
+        ("connect4", Connect4(config.R, config.C, config.N_IN_A_ROW)),
+        ("bitboard", BitboardConnect4(config.R, config.C, config.N_IN_A_ROW)),
+    ]
+    for name, connect4 in engines:
+        copies = [[np.copy(state) for state in states] for _ in range(WARMUP + REPEATS)]
+
+        def transition():
+            batch = copies.pop()
+            for state, (_, action) in zip(batch, positions):
+                connect4.transition_and_evaluate(state, action)
+
+        def legal():
+            for state in states:
+                connect4.get_legal_actions(state[:2])
+
+        results["env.%s.transition_and_evaluate" % name] = result(
+            measure(transition) / len(positions) * 1e6, "us/call")
+        results["env.%s.get_legal_actions" % name] = result(
+            measure(legal) / len(positions) * 1e6, "us/call")
+
+    connect4 = engines[0][1]
+    bitboard = engines[1][1]
+
+    # with the bitboards carried next to the states instead of rebuilt
+    boards = [bitboard.get_boards(state) for state in states]
+    copies = [[(np.copy(state), list(board)) for state, board in zip(states, boards)]
+              for _ in range(WARMUP + REPEATS)]
+
+    def carried_transition():
+        batch = copies.pop()
+        for (state, board), (_, action) in zip(batch, positions):
+            bitboard.transition_and_evaluate(state, action, boards=board)
+
+    results["env.bitboard.transition_and_evaluate_boards"] = result(
+        measure(carried_transition) / len(positions) * 1e6, "us/call")
+
+    def line_table_check_win():
+        for plane, action in after:
+            connect4.check_win(plane, action)
+
+    bitboards = [bitboard.get_bitboard(plane) for plane, _ in after]
+
+    def bitboard_check_win():
+        for board in bitboards:
+            check_win_bitboard(board, bitboard.height, bitboard.n_in_a_row)
+
+    results["env.connect4.check_win"] = result(
+        measure(line_table_check_win) / len(after) * 1e6, "us/call")
+    results["env.bitboard.check_win"] = result(
+        measure(bitboard_check_win) / len(after) * 1e6, "us/call")
+
+    batched = BatchedConnect4(config.R, config.C, config.N_IN_A_ROW)
+    chosen = np.random.choice(len(positions), config.EPISODE_BATCH_SIZE)
+    batch_states = np.array([positions[k][0] for k in chosen])
+    batch_actions = np.array([positions[k][1] for k in chosen])
+    batch_heights = batched.get_heights(batch_states)
+
+    def batched_step():
+        batched.step(np.copy(batch_states), batch_actions, heights=np.copy(batch_heights))
+
+    results["env.batched.step"] = result(
+        measure(batched_step) / len(chosen) * 1e6, "us/game")
+
+    return results
+
+
+def make_metaqp():
+    from MetaQP import MetaQP
+
+    connect4 = BitboardConnect4(config.R, config.C, config.N_IN_A_ROW)
+    batched = BatchedConnect4(config.R, config.C, config.N_IN_A_ROW)
+    counter = {"positions": 0}
+
+    def transition_and_evaluate(full_state, action, heights=None):
+        counter["positions"] += 1
+        return connect4.transition_and_evaluate(full_state, action, heights)
+
+    def step(states, actions, active=None, heights=None, hashes=None):
+        counter["positions"] += len(actions)
+        return batched.step(states, actions, active, heights, hashes)
+
+    metaqp = MetaQP(actions=connect4.actions,
+                    get_legal_actions=connect4.get_legal_actions,
+                    transition_and_evaluate=transition_and_evaluate,
+                    step=step,
+                    get_legal_mask=batched.get_legal_mask,
+                    cuda=False)
+    metaqp.memories = []
+
+    return metaqp, counter
+
+
+def root_episode(metaqp):
+    num_tasks = config.EPISODE_BATCH_SIZE // config.N_WAY
+    starting_player_list = [task_idx % 2 for task_idx in range(num_tasks)]
+    states = []
+    for starting_player in starting_player_list:
+        state = np.zeros(config.SHAPE, dtype="float32")
+        state[2] = starting_player
+        states.append(state)
+
+    return {
+        "states": states,
+        "heights": metaqp.get_heights(np.array(states)),
+        "hashes": metaqp.get_hashes(np.array(states)),
+        "episode_is_done": [False] * config.EPISODE_BATCH_SIZE,
+        "episode_num_done": 0,
+        "results": {"new": 0, "best": 0, "draw": 0},
+        "best_player": 0,
+        "starting_player_list": starting_player_list,
+    }
+
+
+def bench_qp(metaqp):
+    seed_everything()
+    results = {}
+    qp = metaqp.qp
+    qp.eval()
+    session = InferenceSession(qp, metaqp.cuda)
+
+    for batch_size in QP_BATCH_SIZES:
+        states = np.random.randint(0, 2, size=(batch_size,) + config.SHAPE).astype("float32")
+        policies = np.random.dirichlet([1] * config.R * config.C, size=batch_size)
+
+        state_var = metaqp.wrap_to_variable(states)
+        policies_var = metaqp.wrap_to_variable(policies)
+
+        results["qp.forward.policy.b%d" % batch_size] = result(
+            measure(lambda: qp(state_var, percent_random=.2)) * 1e3, "ms/batch")
+        results["qp.forward.q.b%d" % batch_size] = result(
+            measure(lambda: qp(state_var, policies_var)) * 1e3, "ms/batch")
+
+        # numpy in and out without autograd, as self-play runs it
+        results["qp.session.policy.b%d" % batch_size] = result(
+            measure(lambda: session(states, percent_random=.2)) * 1e3, "ms/batch")
+        results["qp.session.q.b%d" % batch_size] = result(
+            measure(lambda: session(states, policies)) * 1e3, "ms/batch")
+
+    return results
+
+
+def bench_meta_self_play(metaqp, counter):
+    seed_everything(metaqp=metaqp)
+
+    def one_step():
+        metaqp.meta_self_play(**root_episode(metaqp))
+
+    counter["positions"] = 0
+    for _ in range(WARMUP):
+        one_step()
+
+    counter["positions"] = 0
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        one_step()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "metaqp.meta_self_play": result(counter["positions"] / elapsed, "positions/s",
+                                        higher_is_better=True)
+    }
+
+
+def bench_train_tasks(metaqp):
+    seed_everything(metaqp=metaqp)
+    tasks = list(metaqp.memories)
+    while len(tasks) < config.TRAINING_BATCH_SIZE // config.N_WAY:
+        metaqp.meta_self_play(**root_episode(metaqp))
+        tasks = list(metaqp.memories)
+
+    minibatch = tasks[:config.TRAINING_BATCH_SIZE // config.N_WAY]
+    num_samples = sum(len(task["memories"]) for task in minibatch)
+
+    seconds = measure(lambda: metaqp.train_tasks(minibatch))
+
+    return {
+        "metaqp.train_tasks": result(num_samples * config.EPOCHS / seconds, "samples/s",
+                                     higher_is_better=True)
+    }
+
+
+def run_all():
+    results = bench_env()
+
+    metaqp, counter = make_metaqp()
+    results.update(bench_qp(metaqp))
+    results.update(bench_meta_self_play(metaqp, counter))
+    results.update(bench_train_tasks(metaqp))
+
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "threads": torch.get_num_threads(),
+        "seed": SEED,
+        "warmup": WARMUP,
+        "repeats": REPEATS,
+        "episode_batch_size": config.EPISODE_BATCH_SIZE,
+        "n_way": config.N_WAY,
+    }
+
+
+def compare(baseline, current, threshold):
+    """Prints the change of every benchmark and returns the regressed names."""
+    regressions = []
+    for name in sorted(current["results"]):
+        if name not in baseline["results"]:
+            continue
+        old = baseline["results"][name]
+        new = current["results"][name]
+        change = (new["value"] - old["value"]) / old["value"]
+        worse = -change if new["higher_is_better"] else change
+        flag = ""
+        if worse > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print("{:<40} {:>12.3f} -> {:>12.3f} {:<12} {:+7.1%}{}".format(
+            name, old["value"], new["value"], new["unit"], change, flag))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", default="checkpoints/benchmarks.json")
+    parser.add_argument("--compare", default=None,
+                        help="earlier results to compare against")
+    parser.add_argument("--threshold", type=float, default=.1,
+                        help="relative slowdown counted as a regression")
+    args = parser.parse_args()
+
+    current = {"meta": metadata(), "results": run_all()}
+
+    with open(args.output, "w") as f:
+        json.dump(current, f, indent=2, sort_keys=True)
+    print("Saved benchmarks to {}".format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, current, args.threshold):
+            raise SystemExit(1)
+    else:
+        for name, entry in sorted(current["results"].items()):
+            print("{:<40} {:>12.3f} {}".format(name, entry["value"], entry["unit"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""Inference-only QP with every batchnorm folded into its conv, traced.
+
+    python compiled.py
+    python compiled.py --name qp --batch-sizes 1 60 600
+
+In eval mode a batchnorm is a fixed per-channel affine map, so it can be
+folded into the weights and bias of the 1x1 conv in front of it: every
+ResBlock loses both of its batchnorms and the heads lose theirs. The fused
+copy is traced with torch.jit (embed, policy and q separately, so it
+keeps the split QP interface) and wrapped in CompiledQP, which adds the
+percent_random noise in Python just like PolicyModule does.
+
+Run as a script it compiles checkpoints/models/<name>_best.t7, checks the
+outputs against the eager model, saves the traced module next to the
+checkpoint as <name>_best.pt and prints the latency of both across batch
+sizes.
+"""
+import argparse
+import copy
+import os
+import warnings
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import config
+from models import ResBlock, QHead, PolicyHead, add_policy_noise
+
+
+def fold_batchnorm(conv, bn):
+    """A copy of conv computing bn(conv(x)) with bn's running statistics."""
+    scale = bn.running_var.add(bn.eps).rsqrt()
+    if bn.weight is not None:
+        scale = scale * bn.weight.data
+
+    shift = -bn.running_mean * scale
+    if bn.bias is not None:
+        shift = shift + bn.bias.data
+
+    fused = copy.deepcopy(conv)
+    fused.weight.data = conv.weight.data * scale.view(-1, 1, 1, 1)
+    bias = conv.bias.data if conv.bias is not None else torch.zeros_like(shift)
+    fused.bias = nn.Parameter(bias * scale + shift)
+
+    return fused
+
+
+def fuse_qp(qp):
+    """An eval mode copy of qp with the batchnorms folded into the convs."""
+    fused = copy.deepcopy(qp).eval()
+    for module in fused.modules():
+        if isinstance(module, ResBlock):
+            module.conv1 = fold_batchnorm(module.conv1, module.bn1)
+            module.conv2 = fold_batchnorm(module.conv2, module.bn2)
+            # an empty Sequential passes its input straight through
+            module.bn1 = nn.Sequential()
+            module.bn2 = nn.Sequential()
+        elif isinstance(module, (QHead, PolicyHead)):
+            module.conv1 = fold_batchnorm(module.conv1, module.bn1)
+            module.bn1 = nn.Sequential()
+
+    return fused
+
+
+def trace_qp(qp, batch_size=2):
+    """Traces embed, policy and q of the fused qp.
+
+    Batch sizes stay dynamic; the example batch only has to be bigger than
+    one so no size gets baked in as a constant.
+    """
+    fused = fuse_qp(qp)
+    parameter = next(fused.parameters())
+    state = parameter.new_zeros((batch_size,) + config.SHAPE)
+
+    with torch.no_grad(), warnings.catch_warnings():
+        # ResBlock compares shapes in Python, which is fixed per block
+        warnings.simplefilter("ignore", torch.jit.TracerWarning)
+        state_out = fused.embed(state)
+        policy = fused.policy(state_out)
+        return torch.jit.trace_module(fused, {
+            "embed": (state,),
+            "policy": (state_out,),
+            "q": (state_out, policy),
+        })
+
+
+class CompiledQP:
+    """Drop-in for QP at inference time, running a traced fused module.
+
+    Supports the same calls as QP (and so can be wrapped by SymmetricQP,
+    DualQP or an InferenceSession), but has no parameters to train.
+    """
+    def __init__(self, traced):
+        self.traced = traced
+
+    def eval(self):
+        return self
+
+    def embed(self, state):
+        return self.traced.embed(state)
+
+    def policy(self, state_out, percent_random=None):
+        policy = self.traced.policy(state_out)
+        if percent_random is not None:
+            policy = add_policy_noise(policy, percent_random)
+        return policy
+
+    def select(self, state_out, index):
+        return state_out.index_select(0, index)
+
+    def q(self, state_out, policy):
+        return self.traced.q(state_out, policy)
+
+    def __call__(self, state, policy=None, percent_random=None):
+        state_out = self.embed(state)
+
+        if policy is None:
+            policy = self.policy(state_out, percent_random)
+
+        return self.q(state_out, policy), policy
+
+
+def compile_qp(qp):
+    return CompiledQP(trace_qp(qp))
+
+
+def compiled_path(name="qp"):
+    return "checkpoints/models/%s_best.pt" % name
+
+
+def export(qp, name="qp"):
+    """Compiles qp and saves it next to its checkpoint, returns the CompiledQP."""
+    compiled = compile_qp(qp)
+    compiled.traced.save(compiled_path(name))
+    return compiled
+
+
+def load_compiled(name="qp"):
+    """The exported CompiledQP for name, or None if there is none or the
+    checkpoint has been saved since."""
+    checkpoint = "checkpoints/models/%s_best.t7" % name
+    if not os.path.exists(compiled_path(name)) or not os.path.exists(checkpoint) \
+            or os.path.getmtime(compiled_path(name)) < os.path.getmtime(checkpoint):
+        return None
+    return CompiledQP(torch.jit.load(compiled_path(name)))
+
+
+def main():
+    from benchmarks import measure
+    import model_utils
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--name", default="qp")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 60, 120, 600])
+    args = parser.parse_args()
+
+    qp = model_utils.load_model(args.name).eval()
+    compiled = export(qp, args.name)
+    print("Saved {}".format(compiled_path(args.name)))
+
+    print("{:>6} {:>12} {:>12} {:>8} {:>10} {:>10}".format(
+        "batch", "eager ms", "compiled ms", "speedup", "max |dP|", "max |dQ|"))
+    with torch.no_grad():
+        for batch_size in args.batch_sizes:
+            states = torch.from_numpy(np.random.randint(
+                0, 2, size=(batch_size,) + config.SHAPE).astype("float32"))
+
+            Q, policy = qp(states)
+            compiled_Q, compiled_policy = compiled(states)
+            policy_error = (policy - compiled_policy).abs().max().item()
+            q_error = (Q - compiled_Q).abs().max().item()
+
+            eager = measure(lambda: qp(states)) * 1e3
+            fused = measure(lambda: compiled(states)) * 1e3
+            print("{:>6} {:>12.2f} {:>12.2f} {:>7.2f}x {:>10.1e} {:>10.1e}".format(
+                batch_size, eager, fused, eager / fused, policy_error, q_error))
+
+
+if __name__ == "__main__":
+    main()
+
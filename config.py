@@ -4,10 +4,49 @@ BATCH_SIZE = 120
 TRAINING_BATCH_SIZE = 100
 EPISODE_BATCH_SIZE = 60
 N_WAY=10
+# refill finished task slots from the root instead of waiting for the
+# whole episode, see MetaQP.run_stream
+STREAMING_SELF_PLAY = False
+# self-play processes sharing one batched inference server, see actors.py
+NUM_ACTORS = 1
+# seconds the server waits for more requests before running a partial batch
+INFERENCE_SERVER_TIMEOUT = .005
+# play games as asyncio coroutines sharing batched forward passes, see scheduler.py
+ASYNC_SELF_PLAY = False
+# seconds a partial batch waits for more requests before it is run, None
+# runs it once every game and rollout is waiting on a forward pass
+DISPATCH_DEADLINE = None
+# games played at once; each holds up to N_WAY rollouts, split between the
+# two models, so the batches only fill up with a few times
+# EPISODE_BATCH_SIZE // N_WAY games in flight
+ASYNC_GAMES_IN_FLIGHT = 30
 
 # Training #
 # EPISODES=30
+# plies a rollout is played before its result is replaced by the Q
+# estimate of the position reached, None plays every rollout to the end
+ROLLOUT_HORIZON = None
 SCORING_THRESHOLD = 1.2
+# gate on evaluation games, played in EVALUATION_BATCH_SIZE chunks until a
+# sequential probability ratio test tells qp and best_qp apart, see gating.py
+SPRT_GATING = False
+# chance of promoting a model that is SCORING_THRESHOLD times worse, and
+# of reverting one that is SCORING_THRESHOLD times better
+SPRT_ALPHA = .05
+SPRT_BETA = .05
+SPRT_MAX_GAMES = 600
+# None plays qp against best_qp in self-play and gates on those games;
+# "qp" or "best" plays that model against itself at full batch and gates
+# with deterministic evaluation games instead, see evaluation.py
+SELF_PLAY_MODEL = None
+# training iterations between evaluations
+EVALUATION_INTERVAL = 5
+# games per evaluation batch, each from its own opening, half with best_qp
+# on either side
+EVALUATION_BATCH_SIZE = 120
+# random plies before the models take over, from a fixed seed
+EVALUATION_OPENING_PLIES = 4
+EVALUATION_SEED = 0
 
 TRAINING_LOOPS = 25
 EPOCHS = 3
@@ -29,6 +68,9 @@ C = 7
 
 SHAPE = (CH, R, C)
 
+# pieces in a row needed to win
+N_IN_A_ROW = 4
+
 TRAINING_BATCH_SHAPE = (TRAINING_BATCH_SIZE, CH, R, C)
 EPISODE_BATCH_SHAPE = (EPISODE_BATCH_SIZE, CH, R, C)
 
@@ -50,3 +92,29 @@ NUM_Q_RES_FILTERS = NUM_RES_FILTERS
 NUM_P_RES_FILTERS = NUM_RES_FILTERS
 
 POLICY_HEAD_FILTERS = 30
+
+###
+#Inference Caches
+###
+TRANSPOSITION_TABLE_SIZE = 100000
+# evaluate self-play states in canonical (mirror-reduced) form
+CANONICAL_INFERENCE = True
+# intra-op threads of each of the qp/best_qp workers, None splits the
+# current budget in half
+DUAL_MODEL_THREADS = None
+# self-play runs traced copies of the models with the batchnorms folded
+# into the convs, see compiled.py
+COMPILED_INFERENCE = False
+# self-play runs int8 copies of the models calibrated on the latest
+# recorded self-play states, CPU only and ahead of COMPILED_INFERENCE,
+# see quantized.py
+QUANTIZED_INFERENCE = False
+CALIBRATION_STATES = 1000
+# int8 only pays off on big batches, smaller ones run the traced float copy
+QUANTIZED_MIN_BATCH = 60
+# positions whose embedding and pre-noise policy are kept between forward
+# passes, see CachedQP. Off by default: an entry is about 20KB at 120
+# filters, so 10000 entries take ~200MB (in the inference server, with actors).
+# Keyed on the carried hashes, self-play hits ~4% of lookups with 10000
+# entries and ~4.5% with 100000, for 1-5% more rollout positions/s
+INFERENCE_CACHE_SIZE = 0
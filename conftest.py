@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+import config
+from Connect4 import BitboardConnect4, BatchedConnect4
+
+
+@pytest.fixture
+def metaqp(tmp_path, monkeypatch):
+    """A MetaQP on the bitboard and batched engines, built in a temporary
+    directory so it starts from untrained models and empty memories and
+    writes nothing to checkpoints/."""
+    from MetaQP import MetaQP
+
+    monkeypatch.chdir(tmp_path)
+    np.random.seed(0)
+    connect4 = BitboardConnect4(config.R, config.C, config.N_IN_A_ROW)
+    batched = BatchedConnect4(config.R, config.C, config.N_IN_A_ROW)
+
+    metaqp = MetaQP(actions=connect4.actions,
+                    get_legal_actions=connect4.get_legal_actions,
+                    transition_and_evaluate=connect4.transition_and_evaluate,
+                    step=batched.step,
+                    get_legal_mask=batched.get_legal_mask,
+                    cuda=False)
+    metaqp.memories = []
+    metaqp.rng = np.random.default_rng(0)
+    return metaqp
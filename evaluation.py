@@ -0,0 +1,95 @@
+"""Deterministic qp against best_qp games for gating.
+
+Used by MetaQP.run_evaluation when self-play only runs one model (see
+config.SELF_PLAY_MODEL), so gating no longer rides on the noisy training
+games. Every game starts from its own random opening of
+config.EVALUATION_OPENING_PLIES plies, with best_qp on one side in the
+first half of a batch and on the other in the second half, so each game is
+an independent sample for the SPRT in MetaQP.gate. From there both models
+play the legal move their policy likes best, with no noise and no
+rollouts. The openings come from config.EVALUATION_SEED, so each
+evaluation plays the same games whatever the checkpoint, and successive
+chunks of one evaluation play new ones.
+"""
+import numpy as np
+
+import config
+from inference import InferenceSession
+
+
+class Evaluator:
+    def __init__(self, metaqp, batch_size=config.EVALUATION_BATCH_SIZE,
+                 seed=config.EVALUATION_SEED):
+        self.metaqp = metaqp
+        self.batch_size = batch_size
+        self.rng = np.random.RandomState(seed)
+
+    def openings(self, root_state, num_openings):
+        states = []
+        while len(states) < num_openings:
+            state = np.array(root_state, dtype="float32")
+            state[2] = self.rng.randint(2)
+            heights = self.metaqp.get_heights(state[None])[0]
+            game_over = False
+            for _ in range(config.EVALUATION_OPENING_PLIES):
+                action = self.rng.choice(self.metaqp.get_legal_actions(state[:2], heights))
+                state, _, game_over = self.metaqp.transition_and_evaluate(state, action, heights)
+                if game_over:
+                    break
+            if not game_over:
+                states.append(state)
+
+        return np.array(states)
+
+    def step(self, states, actions, heights, hashes):
+        # (rewards, done) of one move in every game, in place
+        if self.metaqp.step is not None:
+            _, rewards, done = self.metaqp.step(states, actions, heights=heights, hashes=hashes)
+            return rewards, done
+
+        hashes[:] = self.metaqp.zobrist.update_pairs(
+            hashes, states[:, 2, 0, 0].astype("int64"), actions)
+        rewards = np.zeros(len(states))
+        done = np.zeros(len(states), dtype=bool)
+        for k, (state, action) in enumerate(zip(states, actions)):
+            _, reward, done[k] = self.metaqp.transition_and_evaluate(state, action, heights[k])
+            if done[k]:
+                rewards[k] = reward
+        return rewards, done
+
+    def play_games(self, states, best_player, results):
+        """Plays the games in states to the end, best_qp moving for best_player."""
+        metaqp = self.metaqp
+        session = InferenceSession(metaqp.dual_model(best_player), metaqp.cuda)
+        heights = metaqp.get_heights(states)
+        hashes = metaqp.get_hashes(states)
+
+        while len(states):
+            policies = session.policy(session.embed(states, hashes))
+            legal = metaqp.legal_mask(states, heights)
+            actions = np.where(legal, policies, -1).argmax(axis=1)
+            rewards, done = self.step(states, actions, heights, hashes)
+
+            for state, reward in zip(states[done], rewards[done]):
+                # the player who just moved made the last move
+                winner = 1 - int(state[2][0][0])
+                if reward == 0:
+                    results["draw"] += 1
+                elif winner == best_player:
+                    results["best"] += 1
+                else:
+                    results["new"] += 1
+
+            states = states[~done]
+            heights = heights[~done]
+            hashes = hashes[~done]
+
+    def play(self, root_state):
+        """Results of one batch of evaluation games."""
+        results = {"new": 0, "best": 0, "draw": 0}
+        openings = self.openings(root_state, self.batch_size)
+        half = len(openings) // 2
+        for best_player, games in enumerate([openings[:half], openings[half:]]):
+            self.play_games(games, best_player, results)
+
+        return results
@@ -0,0 +1,54 @@
+import math
+
+import config
+
+
+def threshold_decision(results, threshold=config.SCORING_THRESHOLD):
+    # promote or revert once either side wins threshold times as many games
+    if results["new"] > results["best"] * threshold:
+        return "promote"
+    if results["best"] > results["new"] * threshold:
+        return "revert"
+    return None
+
+
+class SPRT:
+    """Wald's sequential probability ratio test between qp and best_qp.
+
+    Draws are left out and p is qp's share of the decisive games. H1 is qp
+    winning threshold times as often as best_qp, p1 = t / (1 + t), and H0
+    the reverse, p0 = 1 / (1 + t), i.e. the two outcomes SCORING_THRESHOLD
+    already gates on. Accepting H1 promotes qp, accepting H0 reverts it.
+    The log likelihood ratio of the games so far is compared against the
+    bounds after every chunk, so clearly better or worse checkpoints are
+    settled after a few chunks. alpha and beta only bound the error rates
+    if every result counted is an independent game.
+    """
+    def __init__(self, threshold=config.SCORING_THRESHOLD,
+                 alpha=config.SPRT_ALPHA, beta=config.SPRT_BETA):
+        self.p0 = 1 / (1 + threshold)
+        self.p1 = threshold / (1 + threshold)
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+        self.results = {"new": 0, "best": 0, "draw": 0}
+
+    def update(self, results):
+        for key in self.results:
+            self.results[key] += results[key]
+
+    def games(self):
+        return sum(self.results.values())
+
+    def llr(self):
+        return (self.results["new"] * math.log(self.p1 / self.p0) +
+                self.results["best"] * math.log((1 - self.p1) / (1 - self.p0)))
+
+    def decision(self):
+        """"promote", "revert" or None while undecided."""
+        llr = self.llr()
+        if llr >= self.upper:
+            return "promote"
+        if llr <= self.lower:
+            return "revert"
+        return None
+
@@ -0,0 +1,450 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+
+import torch
+from torch.autograd import Variable
+import numpy as np
+
+import config
+from Connect4 import canonicalize_batch, mirror_actions, mirror_states
+from models import add_policy_noise
+from transposition_table import TranspositionTable
+
+
+def inference_mode():
+    # inference_mode skips autograd bookkeeping entirely, no_grad is the
+    # closest thing on versions of torch that predate it
+    if hasattr(torch, "inference_mode"):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def is_inference_mode():
+    return hasattr(torch, "is_inference_mode_enabled") and torch.is_inference_mode_enabled()
+
+
+# rows of the InferenceSession call running on this thread
+_session = threading.local()
+
+
+@contextmanager
+def session_rows(rows):
+    """Records rows, the batch size of the InferenceSession call being run,
+    for models that sit below a SymmetricQP or DualQP split and would
+    otherwise only see their own sub-batch (see QuantizedQP)."""
+    outer = current_session_rows()
+    _session.rows = rows
+    try:
+        yield
+    finally:
+        _session.rows = outer
+
+
+def current_session_rows():
+    return getattr(_session, "rows", None)
+
+
+def wrap_like(numpy_array, like):
+    # Variable on the same device as the Variable like
+    var = Variable(torch.from_numpy(np.ascontiguousarray(numpy_array)))
+    if like.is_cuda:
+        var = var.cuda()
+    return var
+
+
+def embed_hashed(qp, state, hashes):
+    # hashes, the (B, 2) Zobrist pairs the caller carries along with the
+    # states (see ZobristHash.hash_pairs), only go to wrappers that use them
+    if hashes is None or not getattr(qp, "takes_hashes", False):
+        return qp.embed(state)
+    return qp.embed(state, hashes)
+
+
+# trunk output of the unique canonical states, plus what is needed to map
+# results back onto the original batch
+CanonicalEmbedding = namedtuple("CanonicalEmbedding",
+                                ["state_out", "inverse", "flipped", "symmetric"])
+
+
+class SymmetricQP:
+    """Wraps QP.forward so only canonical states are evaluated.
+
+    A Connect4 position and its left-right mirror have the same value and
+    mirrored policies, so every state is replaced by its canonical form,
+    duplicate states in the batch are evaluated once, and the policies are
+    mirrored back for the states that were flipped. States that are their
+    own mirror get the average of the policy and its mirror. Given the
+    Zobrist pairs of the states, the orientation with the smaller hash is
+    the canonical one and duplicates are found by hash, so the boards are
+    never compared.
+
+    Called like QP: qp(state) / qp(state, percent_random=.2) for policies and
+    qp(state, policy) for Q values, or split like QP into embed(state) and
+    any number of policy(emb) / q(emb, policy) calls. Noise is mixed in after
+    un-mirroring so every row still gets its own draw; the Q returned
+    alongside a generated policy is the Q of the policy before noise.
+    """
+    takes_hashes = True
+
+    def __init__(self, qp):
+        self.qp = qp
+        self.mirror_index = mirror_actions(config.R, config.C)
+        self.identity_index = np.arange(config.R*config.C)
+
+    def eval(self):
+        self.qp.eval()
+        return self
+
+    def mirror_policies(self, policy, flipped, like):
+        # the mirror is its own inverse, so one gather maps both ways
+        index = np.where(flipped[:, None], self.mirror_index, self.identity_index)
+        return policy.gather(1, wrap_like(index, like))
+
+    def embed(self, state, hashes=None):
+        """Runs the trunk once per unique canonical state in the batch."""
+        states = state.data.cpu().numpy()
+        if hashes is None:
+            canonical, flipped = canonicalize_batch(states)
+
+            _, unique_idx, inverse = np.unique(canonical.reshape(len(states), -1), axis=0,
+                                               return_index=True, return_inverse=True)
+
+            unique_states = canonical[unique_idx]
+            symmetric = (unique_states == mirror_states(unique_states)).reshape(
+                len(unique_states), -1).all(axis=1)
+            unique_hashes = None
+        else:
+            flipped = hashes[:, 1] < hashes[:, 0]
+            canonical_hashes = np.where(flipped[:, None], hashes[:, ::-1], hashes)
+
+            _, unique_idx, inverse = np.unique(canonical_hashes[:, 0],
+                                               return_index=True, return_inverse=True)
+
+            unique_hashes = canonical_hashes[unique_idx]
+            symmetric = unique_hashes[:, 0] == unique_hashes[:, 1]
+            unique_states = states[unique_idx]
+            unique_states = np.where(flipped[unique_idx, None, None, None],
+                                     mirror_states(unique_states), unique_states)
+
+        state_out = embed_hashed(self.qp, wrap_like(unique_states, state), unique_hashes)
+
+        return CanonicalEmbedding(state_out, wrap_like(inverse.reshape(-1), state),
+                                  flipped, symmetric)
+
+    def unique_policy(self, embedding):
+        policy = self.qp.policy(embedding.state_out)
+
+        if embedding.symmetric.any():
+            like = policy
+            symmetric = wrap_like(embedding.symmetric[:, None], like)
+            mirrored_policy = policy[:, wrap_like(self.mirror_index, like)]
+            policy = torch.where(symmetric, (policy + mirrored_policy) / 2, policy)
+
+        return policy
+
+    def expand_policy(self, embedding, unique_policy, percent_random=None):
+        policy = self.mirror_policies(unique_policy[embedding.inverse], embedding.flipped,
+                                      unique_policy)
+
+        if percent_random is not None:
+            policy = add_policy_noise(policy, percent_random)
+
+        return policy
+
+    def policy(self, embedding, percent_random=None):
+        return self.expand_policy(embedding, self.unique_policy(embedding), percent_random)
+
+    def select(self, embedding, index):
+        return embedding._replace(inverse=embedding.inverse.index_select(0, index),
+                                  flipped=embedding.flipped[index.data.cpu().numpy()])
+
+    def q(self, embedding, policy):
+        canonical_policy = self.mirror_policies(policy, embedding.flipped, policy)
+        return self.qp.q(self.qp.select(embedding.state_out, embedding.inverse),
+                         canonical_policy)
+
+    def __call__(self, state, policy=None, percent_random=None):
+        embedding = self.embed(state)
+
+        if policy is not None:
+            return self.q(embedding, policy), policy
+
+        unique_policy = self.unique_policy(embedding)
+        Q = self.qp.q(embedding.state_out, unique_policy)[embedding.inverse]
+
+        return Q, self.expand_policy(embedding, unique_policy, percent_random)
+
+
+class InferenceCache(TranspositionTable):
+    """TranspositionTable of CachedQP entries, safe to share between the
+    DualQP workers."""
+    def __init__(self, max_size=config.INFERENCE_CACHE_SIZE):
+        super(InferenceCache, self).__init__(max_size)
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            return super(InferenceCache, self).get(key, default)
+
+    def put(self, key, value):
+        with self.lock:
+            super(InferenceCache, self).put(key, value)
+
+
+# trunk output of the batch, plus the cache key and entry of every row
+CachedEmbedding = namedtuple("CachedEmbedding", ["state_out", "keys", "entries"])
+
+
+class CachedQP:
+    """Wraps a QP so positions it has already seen skip the network.
+
+    Entries are keyed by (Zobrist hash, version), where version stands for
+    the model's current weights: once they change the owner hands out a new
+    version and the old entries are never hit again, they just age out of
+    the LRU. The hashes are the ones the caller carries along with the
+    states when it passes them, the board is only hashed when it does not. An entry holds the trunk embedding and, once asked for, the
+    policy before percent_random noise, so noise is still drawn per call.
+    Q values depend on the policy they are asked about and are not cached.
+    """
+    takes_hashes = True
+
+    def __init__(self, qp, cache, version, zobrist):
+        self.qp = qp
+        self.cache = cache
+        self.version = version
+        self.zobrist = zobrist
+
+    def eval(self):
+        self.qp.eval()
+        return self
+
+    def embed(self, state, hashes=None):
+        if hashes is None:
+            hashes = self.zobrist.hash_batch(state.data.cpu().numpy())
+        else:
+            hashes = hashes[:, 0]
+        keys = [(hashed, self.version) for hashed in hashes.tolist()]
+        entries = [self.cache.get(key) for key in keys]
+
+        missing = [k for k, entry in enumerate(entries) if entry is None]
+        if missing:
+            state_out = self.qp.embed(state.index_select(0, wrap_like(missing, state)))
+            for k, row in zip(missing, state_out):
+                # a clone so the entry does not keep the whole batch alive
+                entries[k] = {"state_out": row.clone(), "policy": None}
+                self.cache.put(keys[k], entries[k])
+
+        state_out = torch.stack([entry["state_out"] for entry in entries])
+        return CachedEmbedding(state_out, keys, entries)
+
+    def policy(self, embedding, percent_random=None):
+        entries = embedding.entries
+        missing = [k for k, entry in enumerate(entries) if entry["policy"] is None]
+        if missing:
+            policy = self.qp.policy(embedding.state_out.index_select(
+                0, wrap_like(missing, embedding.state_out)))
+            for k, row in zip(missing, policy):
+                entries[k]["policy"] = row.clone()
+
+        policy = torch.stack([entry["policy"] for entry in entries])
+        if percent_random is not None:
+            policy = add_policy_noise(policy, percent_random)
+        return policy
+
+    def select(self, embedding, index):
+        rows = index.data.cpu().numpy()
+        return CachedEmbedding(embedding.state_out.index_select(0, index),
+                               [embedding.keys[k] for k in rows],
+                               [embedding.entries[k] for k in rows])
+
+    def q(self, embedding, policy):
+        return self.qp.q(embedding.state_out, policy)
+
+    def __call__(self, state, policy=None, percent_random=None):
+        embedding = self.embed(state)
+
+        if policy is None:
+            policy = self.policy(embedding, percent_random)
+
+        return self.q(embedding, policy), policy
+
+
+# per model sub-batch embeddings; owners[k] is the model evaluating row k and
+# local[k] its position in that model's sub-batch
+DualEmbedding = namedtuple("DualEmbedding", ["embeddings", "owners", "local"])
+
+
+def model_pool(threads=config.DUAL_MODEL_THREADS):
+    """Two workers, one per model, each running torch with threads intra-op
+    threads (half of the current budget by default)."""
+    if threads is None:
+        threads = max(1, torch.get_num_threads() // 2)
+    return ThreadPoolExecutor(2, initializer=torch.set_num_threads, initargs=(threads,))
+
+
+class DualQP:
+    """Evaluates every row with the model that owns its move.
+
+    Rows whose player to move is best_player go to best_qp, the others to
+    qp. The two sub-batches run concurrently on the workers of pool and the
+    outputs are put back in batch order, so games of either parity can
+    share one minibatch. Supports the same calls as QP and SymmetricQP.
+    """
+    takes_hashes = True
+
+    def __init__(self, qp, best_qp, best_player, pool):
+        self.models = [qp, best_qp]
+        self.best_player = best_player
+        self.pool = pool
+
+    def eval(self):
+        for model in self.models:
+            model.eval()
+        return self
+
+    def owners(self, state):
+        # 1 where best_qp owns the move
+        players = state.data[:, 2, 0, 0].cpu().numpy()
+        return (players == self.best_player).astype("int64")
+
+    def embedding(self, embeddings, owners):
+        local = np.zeros(len(owners), dtype="int64")
+        for owner in range(2):
+            local[owners == owner] = np.arange(np.count_nonzero(owners == owner))
+        return DualEmbedding(embeddings, owners, local)
+
+    def map(self, fn, owners):
+        """Runs fn(owner, rows) for both models concurrently and concatenates
+        the outputs back into batch order."""
+        groups = [(owner, np.flatnonzero(owners == owner)) for owner in range(2)]
+        groups = [(owner, rows) for owner, rows in groups if len(rows)]
+
+        # grad and inference mode, like the session rows, are thread local,
+        # so the workers have to be put in the caller's
+        inference = is_inference_mode()
+        grad = torch.is_grad_enabled()
+        batch_rows = current_session_rows()
+
+        def run(owner, rows):
+            with inference_mode() if inference else torch.set_grad_enabled(grad):
+                with session_rows(batch_rows):
+                    return fn(owner, rows)
+
+        futures = [self.pool.submit(run, owner, rows) for owner, rows in groups]
+        outputs = [future.result() for future in futures]
+
+        if len(outputs) == 1:
+            return outputs[0]
+
+        order = np.concatenate([rows for _, rows in groups])
+        inverse = np.argsort(order)
+        return tuple(torch.cat(parts).index_select(0, wrap_like(inverse, parts[0]))
+                     for parts in zip(*outputs))
+
+    def __call__(self, state, policy=None, percent_random=None):
+        def run(owner, rows):
+            index = wrap_like(rows, state)
+            sub_policy = None if policy is None else policy.index_select(0, index)
+            return self.models[owner](state.index_select(0, index), sub_policy, percent_random)
+
+        return self.map(run, self.owners(state))
+
+    def embed(self, state, hashes=None):
+        owners = self.owners(state)
+        embeddings = [None, None]
+
+        def run(owner, rows):
+            embeddings[owner] = embed_hashed(
+                self.models[owner], state.index_select(0, wrap_like(rows, state)),
+                None if hashes is None else hashes[rows])
+            return ()
+
+        self.map(run, owners)
+        return self.embedding(embeddings, owners)
+
+    def policy(self, embedding, percent_random=None):
+        def run(owner, rows):
+            return (self.models[owner].policy(embedding.embeddings[owner], percent_random),)
+
+        return self.map(run, embedding.owners)[0]
+
+    def q(self, embedding, policy):
+        def run(owner, rows):
+            index = wrap_like(rows, policy)
+            return (self.models[owner].q(embedding.embeddings[owner],
+                                         policy.index_select(0, index)),)
+
+        return self.map(run, embedding.owners)[0]
+
+    def select(self, embedding, index):
+        rows = index.data.cpu().numpy()
+        owners = embedding.owners[rows]
+        local = embedding.local[rows]
+        embeddings = [None, None]
+        for owner in range(2):
+            selected = local[owners == owner]
+            if len(selected):
+                embeddings[owner] = self.models[owner].select(
+                    embedding.embeddings[owner], wrap_like(selected, index))
+
+        return self.embedding(embeddings, owners)
+
+
+# the model's embedding and the number of rows it stands for
+SessionEmbedding = namedtuple("SessionEmbedding", ["embedding", "rows"])
+
+
+class InferenceSession:
+    """Evaluation only front end for a QP, SymmetricQP or DualQP.
+
+    Takes and returns numpy arrays: float32 C-contiguous inputs go through
+    torch.from_numpy without a copy, every call runs under inference_mode so
+    no autograd graph is recorded, and outputs are numpy views of the result
+    tensors. Mirrors the QP calls, session(states) / session(states,
+    policies) and embed / policy / select / q, with opaque embeddings.
+    embed also takes the Zobrist pairs of the states when the caller
+    tracks them, for SymmetricQP and CachedQP. Every call records its
+    batch size with session_rows, embeddings remember the rows they were
+    made for.
+    """
+    def __init__(self, qp, cuda=False):
+        self.qp = qp.eval()
+        self.cuda = cuda
+
+    def tensor(self, numpy_array, dtype="float32"):
+        tensor = torch.from_numpy(np.ascontiguousarray(numpy_array, dtype=dtype))
+        if self.cuda:
+            tensor = tensor.cuda()
+        return tensor
+
+    def numpy(self, tensor):
+        return tensor.detach().cpu().numpy()
+
+    def __call__(self, states, policies=None, percent_random=None):
+        with inference_mode(), session_rows(len(states)):
+            if policies is not None:
+                policies = self.tensor(policies)
+            Q, policy = self.qp(self.tensor(states), policies, percent_random)
+
+        return self.numpy(Q), self.numpy(policy)
+
+    def embed(self, states, hashes=None):
+        with inference_mode(), session_rows(len(states)):
+            return SessionEmbedding(embed_hashed(self.qp, self.tensor(states), hashes),
+                                    len(states))
+
+    def policy(self, embedding, percent_random=None):
+        with inference_mode(), session_rows(embedding.rows):
+            return self.numpy(self.qp.policy(embedding.embedding, percent_random))
+
+    def select(self, embedding, index):
+        with inference_mode():
+            return SessionEmbedding(self.qp.select(embedding.embedding,
+                                                   self.tensor(index, dtype="int64")),
+                                    len(index))
+
+    def q(self, embedding, policies):
+        with inference_mode(), session_rows(len(policies)):
+            return self.numpy(self.qp.q(embedding.embedding, self.tensor(policies)))
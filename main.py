@@ -1,25 +1,38 @@
 from MetaQP import MetaQP
-from Connect4 import Connect4
+from Connect4 import BitboardConnect4, BatchedConnect4
 import config
 import numpy as np
 import pickle
-from IPython.core.debugger import set_trace
 import torch
 
-connect4 = Connect4()
+connect4 = BitboardConnect4(config.R, config.C, config.N_IN_A_ROW)
 actions = connect4.actions
 get_legal_actions = connect4.get_legal_actions
 transition_and_evaluate = connect4.transition_and_evaluate
+batched_connect4 = BatchedConnect4(config.R, config.C, config.N_IN_A_ROW)
+step = batched_connect4.step
+get_legal_mask = batched_connect4.get_legal_mask
 
-root_state = np.zeros(shape=(3, 6, 7), dtype="float32")
+root_state = np.zeros(shape=config.SHAPE, dtype="float32")
 iteration = 0
 
 metaqp = MetaQP(actions=actions, get_legal_actions=get_legal_actions,
-    transition_and_evaluate=transition_and_evaluate, cuda=False)
+    transition_and_evaluate=transition_and_evaluate, step=step,
+    get_legal_mask=get_legal_mask, cuda=False)
 
 while True:
     metaqp.train_memories()
-    metaqp.run_episode(root_state)
+    if config.NUM_ACTORS > 1:
+        metaqp.run_actors(root_state)
+    elif config.ASYNC_SELF_PLAY:
+        metaqp.run_async(root_state)
+    elif config.STREAMING_SELF_PLAY:
+        metaqp.run_stream(root_state)
+    else:
+        metaqp.run_episode(root_state)
 
     iteration += 1
+    # with single model self-play, gating runs on its own schedule
+    if config.SELF_PLAY_MODEL is not None and iteration % config.EVALUATION_INTERVAL == 0:
+        metaqp.run_evaluation(root_state)
     print("Iteration Number "+str(iteration))
\ No newline at end of file
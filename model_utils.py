@@ -4,7 +4,6 @@ import torch
 from models import QP
 import config
 
-from IPython.core.debugger import set_trace
 from collections import OrderedDict
 
 
@@ -56,3 +55,6 @@ def load_model(name="qp"):
 def save_model(qp, name="qp"):
     print("Saving best model")
     torch.save(qp, "checkpoints/models/%s_best.t7" % name)
+    if config.COMPILED_INFERENCE:
+        from compiled import export
+        export(qp, name)
@@ -5,8 +5,6 @@ from torch.autograd import Variable
 import numpy as np
 import config
 
-from IPython.core.debugger import set_trace
-
 
 def conv_layer(in_planes, out_planes):
     return nn.Conv2d(in_planes, out_planes, kernel_size=1, stride=1)
@@ -19,6 +17,14 @@ def make_layer(in_dims, h_dims, block, out_dims=None, head="normal"):
     return nn.Sequential(*layers)
 
 
+def add_policy_noise(policy, percent_random):
+    noise = Variable(torch.from_numpy(np.random.uniform(size=(policy.size()[0],
+                                                              config.R*config.C)).astype('float32')))
+    if config.CUDA:
+        noise = noise.cuda()
+    return policy * (1 - percent_random) + noise * percent_random
+
+
 class StateModule(nn.Module):
     def __init__(self):
         super(StateModule, self).__init__()
@@ -170,12 +176,7 @@ class PolicyModule(nn.Module):
         #         (1 - percent_random) + noise * percent_random
 
         if percent_random is not None:
-            noise = Variable(torch.from_numpy(np.random.uniform(size=(state_out.size()[0],
-                                                                      config.R*config.C)).astype('float32')))
-            if config.CUDA:
-                noise = noise.cuda()
-            policy_out = policy_out * \
-                (1 - percent_random) + noise * percent_random
+            policy_out = add_policy_noise(policy_out, percent_random)
 
         policy = policy_out
 
@@ -189,26 +190,42 @@ class QP(nn.Module):
         self.Q = QModule()
         self.P = PolicyModule()
 
-    def forward(self, state, policy=None, percent_random=None):
-        state_out = self.StateModule(state)
+    def embed(self, state):
+        return self.StateModule(state)
 
-        if policy is None:
-            policy = self.P(state_out, percent_random)
-        policy_view = policy.view(state.size()[0], 1, config.R, config.C)
+    def policy(self, state_out, percent_random=None):
+        return self.P(state_out, percent_random)
+
+    def select(self, state_out, index):
+        # e.g. repeat each embedding once per candidate policy
+        return state_out.index_select(0, index)
+
+    def q(self, state_out, policy):
+        policy_view = policy.view(state_out.size()[0], 1, config.R, config.C)
         #state_out = state_out.permute(1, 0, 2, 3)
 
         q_input = torch.cat((state_out, policy_view), dim=1)
 
         #q_input = q_input.permute(1, 0, 2, 3)
 
-        Q = self.Q(q_input)
-
         # might need this view
         # policy_view = policy.view(1, config.BATCH_SIZE, config.R, config.C)
         # Q_input = torch.cat((x.view(self.num_filters, config.BATCH_SIZE, config.R, config.C),
         #     policy_view), axis=0)
         # Q = self.Q(Q_input.view(config.BATCH_SIZE, -1))
 
+        return self.Q(q_input)
+
+    def forward(self, state, policy=None, percent_random=None):
+        # embed/policy/q let callers run the trunk once and reuse it for
+        # several policy and Q queries on the same states
+        state_out = self.embed(state)
+
+        if policy is None:
+            policy = self.policy(state_out, percent_random)
+
+        Q = self.q(state_out, policy)
+
         return Q, policy
 
 
@@ -224,7 +241,7 @@ class ResBlock(nn.Module):
         self.bn2 = nn.BatchNorm2d(out_dims)
 
     def forward(self, x):
-        residual = x.squeeze()
+        residual = x
 
         out = self.conv1(x)
         out = self.bn1(out)
@@ -254,7 +271,7 @@ class QHead(nn.Module):
 
     def forward(self, x):
         x = self.conv1(x)
-        x = self.bn1(x)
+        x = self.bn1(x.view(x.size()[0], x.size()[1], -1)).view_as(x)
         x = self.relu(x)
 
         x = x.view(x.size()[0], -1)
@@ -284,7 +301,8 @@ class PolicyHead(nn.Module):
 
     def forward(self, x):
         x = self.conv1(x)
-        x = self.bn1(x)
+        # BatchNorm1d only takes (N, C, L), normalise over the flattened board
+        x = self.bn1(x.view(x.size()[0], x.size()[1], -1)).view_as(x)
         x = self.relu(x)
 
         logits = self.lin(x.view(x.size()[0], -1))
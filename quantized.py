@@ -0,0 +1,198 @@
+"""Int8 QP for CPU self-play, calibrated on recorded self-play states.
+
+    python quantized.py
+    python quantized.py --name qp --held-out .2 --batch-sizes 1 60 600
+
+Starts from the batchnorm-folded copy of compiled.py and statically
+quantizes every 1x1 conv, PolicyHead.lin and QHead.lin1 to int8. Each
+quantized layer sits between its own quantize and dequantize step, so the
+residual adds, softmax, tanh and the policy concatenated into the Q input
+stay in float and the QP methods work unchanged. Activation ranges come
+from running the float model over calibration states, the task states of
+recorded self-play memories.
+
+Int8 kernels only beat the float ones at about 60 rows and up, and
+self-play runs plenty of smaller batches (the tail of every rollout, the
+task states). QuantizedQP therefore sends calls under
+config.QUANTIZED_MIN_BATCH rows to the traced float copy. The rows counted
+are those of the InferenceSession call, before SymmetricQP and DualQP
+split it into the canonical and per-model sub-batches QuantizedQP sees.
+
+Run as a script it quantizes checkpoints/models/<name>_best.t7 with part
+of the saved memories and reports policy KL and Q MAE against the float
+model on the rest, plus the latency of both across batch sizes.
+"""
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.ao.quantization as quantization
+
+import config
+from compiled import fuse_qp
+from inference import current_session_rows
+from models import QHead, PolicyHead, add_policy_noise
+
+
+class QuantizedLayer(nn.Sequential):
+    # quantized on the way in, float again on the way out
+    def __init__(self, layer):
+        super(QuantizedLayer, self).__init__(
+            quantization.QuantStub(), layer, quantization.DeQuantStub())
+
+    def forward(self, x):
+        # quantized convs hand back channels last, the heads .view() their input
+        return super(QuantizedLayer, self).forward(x).contiguous()
+
+
+def quantizable_layers(qp):
+    """(parent, name) of every layer that gets an int8 kernel."""
+    layers = []
+    for module in qp.modules():
+        for name, child in module.named_children():
+            if isinstance(child, nn.Conv2d):
+                layers.append((module, name))
+        if isinstance(module, PolicyHead):
+            layers.append((module, "lin"))
+        elif isinstance(module, QHead):
+            layers.append((module, "lin1"))
+    return layers
+
+
+def memory_states(memories):
+    """The task states of self-play memories, as one float32 array."""
+    return np.array([task["state"] for task in memories], dtype="float32").reshape(
+        (-1,) + config.SHAPE)
+
+
+def quantize_qp(qp, states, batch_size=config.EPISODE_BATCH_SIZE, engine=None):
+    """An int8 copy of qp calibrated on the (n, CH, R, C) numpy states."""
+    engine = engine or torch.backends.quantized.engine
+    torch.backends.quantized.engine = engine
+
+    quantized = fuse_qp(qp).cpu()
+    for parent, name in quantizable_layers(quantized):
+        layer = QuantizedLayer(getattr(parent, name))
+        layer.qconfig = quantization.get_default_qconfig(engine)
+        setattr(parent, name, layer)
+
+    quantization.prepare(quantized, inplace=True)
+    with torch.no_grad():
+        for start in range(0, len(states), batch_size):
+            quantized(torch.from_numpy(states[start:start+batch_size]))
+    quantization.convert(quantized, inplace=True)
+
+    return quantized
+
+
+class QuantizedQP:
+    """Inference QP running the int8 copy on batches of at least min_batch
+    rows and the float one below that.
+
+    The batch is the one of the InferenceSession call when there is one
+    (see session_rows), the one QuantizedQP is given otherwise. Each call
+    picks on its own, so an embedding from one copy may go through the
+    heads of the other; both produce the same float features. calls counts
+    the calls that went to either copy.
+    """
+    def __init__(self, quantized, fallback, min_batch=config.QUANTIZED_MIN_BATCH):
+        self.quantized = quantized
+        self.fallback = fallback
+        self.min_batch = min_batch
+        self.calls = {"int8": 0, "float": 0}
+
+    def model(self, batch):
+        rows = current_session_rows()
+        if rows is None:
+            rows = len(batch)
+        if rows >= self.min_batch:
+            self.calls["int8"] += 1
+            return self.quantized
+        self.calls["float"] += 1
+        return self.fallback
+
+    def eval(self):
+        return self
+
+    def embed(self, state):
+        return self.model(state).embed(state)
+
+    def policy(self, state_out, percent_random=None):
+        policy = self.model(state_out).policy(state_out)
+        if percent_random is not None:
+            policy = add_policy_noise(policy, percent_random)
+        return policy
+
+    def select(self, state_out, index):
+        return state_out.index_select(0, index)
+
+    def q(self, state_out, policy):
+        return self.model(state_out).q(state_out, policy)
+
+    def __call__(self, state, policy=None, percent_random=None):
+        state_out = self.embed(state)
+
+        if policy is None:
+            policy = self.policy(state_out, percent_random)
+
+        return self.q(state_out, policy), policy
+
+
+def accuracy(qp, quantized, states, batch_size=config.EPISODE_BATCH_SIZE):
+    """Mean policy KL(float || int8) and Q MAE over the numpy states."""
+    kls, errors = [], []
+    with torch.no_grad():
+        for start in range(0, len(states), batch_size):
+            batch = torch.from_numpy(states[start:start+batch_size])
+            Q, policy = qp(batch)
+            quantized_Q, quantized_policy = quantized(batch)
+
+            # the softmax can underflow, keep the logs finite
+            policy = policy.clamp(min=1e-12)
+            quantized_policy = quantized_policy.clamp(min=1e-12)
+            kls.append((policy * (policy.log() - quantized_policy.log())).sum(1))
+            errors.append((Q - quantized_Q).abs().view(-1))
+
+    return {"policy_kl": torch.cat(kls).mean().item(),
+            "q_mae": torch.cat(errors).mean().item()}
+
+
+def main():
+    from benchmarks import measure
+    import model_utils
+    import utils
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--name", default="qp")
+    parser.add_argument("--held-out", type=float, default=.2,
+                        help="fraction of the memories kept out of calibration")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 60, 120, 600])
+    args = parser.parse_args()
+
+    qp = model_utils.load_model(args.name).cpu().eval()
+    states = memory_states(utils.load_memories())
+    if len(states) < 2:
+        raise SystemExit("Need recorded self-play memories to calibrate on")
+    np.random.shuffle(states)
+    split = max(1, int(len(states) * args.held_out))
+    held_out, calibration = states[:split], states[split:]
+
+    quantized = quantize_qp(qp, calibration)
+    print("Calibrated on {} states, {} held out".format(len(calibration), len(held_out)))
+    print("policy KL {policy_kl:.2e}, Q MAE {q_mae:.2e}".format(
+        **accuracy(qp, quantized, held_out)))
+
+    print("{:>6} {:>10} {:>10} {:>8}".format("batch", "float ms", "int8 ms", "speedup"))
+    with torch.no_grad():
+        for batch_size in args.batch_sizes:
+            batch = torch.from_numpy(held_out[np.random.randint(len(held_out), size=batch_size)])
+            float_ms = measure(lambda: qp(batch)) * 1e3
+            int8_ms = measure(lambda: quantized(batch)) * 1e3
+            print("{:>6} {:>10.2f} {:>10.2f} {:>7.2f}x".format(
+                batch_size, float_ms, int8_ms, float_ms / int8_ms))
+
+
+if __name__ == "__main__":
+    main()
+
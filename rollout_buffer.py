@@ -0,0 +1,60 @@
+import numpy as np
+
+import config
+
+
+class RolloutBuffer:
+    """Preallocated storage for the games still being rolled out.
+
+    The live games are kept packed in the first `size` slots of fixed float32
+    arrays. Finished games are swap-removed: the holes they leave below the
+    new size are filled with the live games from the tail, so the prefix
+    stays contiguous, these arrays are never reallocated between plies, and
+    an InferenceSession can read it without a copy. The plies still
+    allocate outside the buffer: the forward pass returns fresh tensors
+    (SymmetricQP and DualQP gather their sub-batches with index_select),
+    and the legal mask is rebuilt every ply; the corrected policies are
+    written straight back into the buffer. Heights and the Zobrist
+    pairs of the states (see ZobristHash.hash_pairs) are carried along and
+    updated by the env step. `rows` maps each slot back to its row in the
+    episode minibatch.
+    """
+    def __init__(self, capacity=config.EPISODE_BATCH_SIZE):
+        self.capacity = capacity
+        self.states = np.zeros((capacity, config.CH, config.R, config.C), dtype="float32")
+        self.heights = np.zeros((capacity, config.C), dtype="int64")
+        self.hashes = np.zeros((capacity, 2), dtype="uint64")
+        self.policies = np.zeros((capacity, config.R*config.C), dtype="float32")
+        self.rows = np.zeros(capacity, dtype="int64")
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def load(self, states, heights, hashes, policies, rows):
+        """Fills the buffer with the given rows of an episode minibatch."""
+        self.size = len(rows)
+        self.states[:self.size] = states[rows]
+        self.heights[:self.size] = heights[rows]
+        self.hashes[:self.size] = hashes[rows]
+        self.policies[:self.size] = policies[rows]
+        self.rows[:self.size] = rows
+
+    def live(self):
+        # numpy views of the packed prefix
+        return (self.states[:self.size], self.heights[:self.size], self.hashes[:self.size],
+                self.policies[:self.size], self.rows[:self.size])
+
+    def remove(self, finished):
+        """Drops the live slots flagged in the boolean array finished."""
+        new_size = self.size - int(np.count_nonzero(finished))
+        holes = np.flatnonzero(finished[:new_size])
+        movers = new_size + np.flatnonzero(np.logical_not(finished[new_size:]))
+
+        self.states[holes] = self.states[movers]
+        self.heights[holes] = self.heights[movers]
+        self.hashes[holes] = self.hashes[movers]
+        self.policies[holes] = self.policies[movers]
+        self.rows[holes] = self.rows[movers]
+        self.size = new_size
+
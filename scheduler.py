@@ -0,0 +1,242 @@
+"""Asyncio self-play where every game advances at its own pace.
+
+Each game, task and rollout is a coroutine that awaits its forward passes
+from a BatchingDispatcher. The dispatcher collects requests from all
+coroutines and runs them through the model once config.EPISODE_BATCH_SIZE
+rows are waiting, or earlier once no more can come: AsyncSelfPlay counts
+the coroutines that may still send a request and flushes every dispatcher
+as soon as all of them are waiting on one. With config.DISPATCH_DEADLINE
+set, a partial batch is run that many seconds after its first request
+instead. Games no longer move in lockstep: a game whose rollouts finish
+early starts its next task straight away and a finished game is replaced
+by a new one from the root.
+"""
+import asyncio
+
+import numpy as np
+
+import config
+from inference import InferenceSession
+
+
+class BatchingDispatcher:
+    def __init__(self, session, batch_size=config.EPISODE_BATCH_SIZE,
+                 deadline=config.DISPATCH_DEADLINE, on_request=None):
+        self.session = session
+        self.batch_size = batch_size
+        self.deadline = deadline
+        # without a deadline, called after every request that leaves a
+        # partial batch and in charge of flushing it; a dispatcher with
+        # neither runs every request straight away
+        self.on_request = on_request if on_request is not None else self.flush
+        self.pending = []
+        self.rows = 0
+        self.timer = None
+        self.batch_sizes = []
+
+    async def policy(self, states):
+        """Policies of the (n, CH, R, C) states, before noise."""
+        return await self.request(states)
+
+    async def q(self, states, policies):
+        """(n, 1) Q values of playing policies[k] from states[k]."""
+        return await self.request(states, policies)
+
+    async def request(self, states, policies=None):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((states, policies, future))
+        self.rows += len(states)
+
+        if self.rows >= self.batch_size:
+            self.flush()
+        elif self.deadline is None:
+            self.on_request()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.deadline, self.flush)
+
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending, self.rows = self.pending, [], 0
+
+        for wants_q in [False, True]:
+            requests = [request for request in pending if (request[1] is not None) == wants_q]
+            if not requests:
+                continue
+
+            states = np.concatenate([states for states, _, _ in requests])
+            if wants_q:
+                policies = np.concatenate([policies for _, policies, _ in requests])
+                outputs, _ = self.session(states, policies)
+            else:
+                _, outputs = self.session(states)
+            self.batch_sizes.append(len(states))
+
+            start = 0
+            for states, _, future in requests:
+                future.set_result(outputs[start:start+len(states)])
+                start += len(states)
+
+    def occupancy(self):
+        """Mean fraction of batch_size filled per forward pass."""
+        if not self.batch_sizes:
+            return 0
+        return float(np.mean(np.minimum(self.batch_sizes, self.batch_size))) / self.batch_size
+
+
+class AsyncSelfPlay:
+    def __init__(self, metaqp):
+        self.metaqp = metaqp
+        self.dispatchers = {
+            "qp": BatchingDispatcher(InferenceSession(
+                metaqp.inference_model(metaqp.qp), metaqp.cuda),
+                on_request=self.flush_if_blocked),
+            "best": BatchingDispatcher(InferenceSession(
+                metaqp.inference_model(metaqp.best_qp), metaqp.cuda),
+                on_request=self.flush_if_blocked),
+        }
+        # coroutines that may still send a request: game workers that are
+        # not waiting on their rollouts, and the running rollouts
+        self.running = 0
+
+    def flush_if_blocked(self):
+        """Flushes every dispatcher once each running coroutine waits on one,
+        since no further request can arrive before then."""
+        waiting = sum(len(dispatcher.pending) for dispatcher in self.dispatchers.values())
+        if waiting < self.running:
+            return
+        for dispatcher in self.dispatchers.values():
+            if dispatcher.pending:
+                dispatcher.flush()
+
+    def stopped(self):
+        self.running -= 1
+        self.flush_if_blocked()
+
+    def correct(self, policies, state, heights):
+        return self.metaqp.correct_policies(
+            policies, np.repeat(state[None], len(policies), axis=0),
+            np.repeat(heights[None], len(policies), axis=0))
+
+    async def rollout(self, state, heights, policy, starting_player, best_player):
+        try:
+            return await self.play_rollout(state, heights, policy, starting_player, best_player)
+        finally:
+            self.stopped()
+
+    async def play_rollout(self, state, heights, policy, starting_player, best_player):
+        """Plays policy from state, then each side with its own model to
+        the end of the game, or to metaqp.rollout_horizon plies where the
+        moving model's Q stands in for the result."""
+        metaqp = self.metaqp
+        state = np.array(state)
+        heights = np.array(heights)
+        plies = 0
+        while True:
+            action = metaqp.sample_actions(policy[None])[0]
+            state, reward, game_over = metaqp.transition_and_evaluate(state, action, heights)
+            if game_over:
+                return metaqp.rollout_result(int(reward), state, starting_player)
+            plies += 1
+
+            dispatcher = self.dispatchers[self.owner(state, best_player)]
+            policy = self.correct(await dispatcher.policy(state[None]), state, heights)[0]
+
+            if metaqp.rollout_horizon is not None and plies >= metaqp.rollout_horizon:
+                qs = await dispatcher.q(state[None], policy[None])
+                return metaqp.rollout_result(-float(qs[0, 0]), state, starting_player)
+
+    def owner(self, state, best_player):
+        if self.metaqp.self_play_model is not None:
+            return self.metaqp.self_play_model
+        return "best" if int(state[2][0][0]) == best_player else "qp"
+
+    async def play_task(self, state, heights, starting_player, best_player):
+        """One meta self-play step: N_WAY noisy candidates from the moving
+        model's policy, their Q weighted improved policy and their rollout
+        results."""
+        dispatcher = self.dispatchers[self.owner(state, best_player)]
+        policy = await dispatcher.policy(state[None])
+
+        candidates = self.correct(self.metaqp.add_policy_noise(
+            np.repeat(policy, config.N_WAY, axis=0)), state, heights)
+
+        qs = await dispatcher.q(np.repeat(state[None], config.N_WAY, axis=0), candidates)
+        scaled_qs = (qs + 1) / 2
+        improved_policy = self.correct(
+            np.sum(candidates * scaled_qs, axis=0, keepdims=True), state, heights)[0]
+
+        # this coroutine waits on its rollouts, which run in its place
+        self.running += len(candidates) - 1
+        rewards = await asyncio.gather(*[
+            self.rollout(state, heights, candidate, starting_player, best_player)
+            for candidate in candidates])
+        self.running += 1
+
+        task = {
+            "state": state,
+            "starting_player": starting_player,
+            "improved_policy": improved_policy,
+            "memories": [{"policy": candidate, "result": reward}
+                         for candidate, reward in zip(candidates, rewards)],
+        }
+        return task, improved_policy
+
+    async def play_game(self, orig_state, results):
+        starting_player = np.random.choice(2)
+        best_player = np.random.choice(2)
+        state = np.array(orig_state)
+        state[2] = starting_player
+        heights = self.metaqp.get_heights(state[None])[0]
+
+        while True:
+            player = int(state[2][0][0])
+            task, improved_policy = await self.play_task(
+                state, heights, starting_player, best_player)
+            self.metaqp.memories.append(task)
+
+            action = self.metaqp.sample_actions(improved_policy[None])[0]
+            state, reward, game_over = self.metaqp.transition_and_evaluate(
+                np.array(state), action, heights)
+            if game_over:
+                break
+
+        if reward == 0:
+            results["draw"] += 1
+        elif player == best_player:
+            results["best"] += 1
+        else:
+            results["new"] += 1
+
+    async def play_games(self, orig_state, results, games):
+        # one game slot, playing games from the shared iterator until none are left
+        try:
+            for _ in games:
+                await self.play_game(orig_state, results)
+        finally:
+            self.stopped()
+
+    async def play(self, orig_state, num_games):
+        results = {"new": 0, "best": 0, "draw": 0}
+        num_slots = min(config.ASYNC_GAMES_IN_FLIGHT, num_games)
+        games = iter(range(num_games))
+        self.running = num_slots
+        await asyncio.gather(*[self.play_games(orig_state, results, games)
+                               for _ in range(num_slots)])
+        return results
+
+
+def play_async(metaqp, orig_state, num_games=config.EPISODE_BATCH_SIZE):
+    """Plays num_games games with the asyncio scheduler, adding their task
+    memories to metaqp.memories, and returns the results."""
+    self_play = AsyncSelfPlay(metaqp)
+    results = asyncio.run(self_play.play(orig_state, num_games))
+
+    for name, dispatcher in self_play.dispatchers.items():
+        print("{} batch occupancy: {:.1%} over {} batches".format(
+            name, dispatcher.occupancy(), len(dispatcher.batch_sizes)))
+
+    return results
@@ -0,0 +1,40 @@
+import time
+from types import SimpleNamespace
+
+import torch
+
+import benchmarks
+from benchmarks import bench_qp, compare, measure, result
+from models import QP
+
+
+def test_measure():
+    calls = []
+    seconds = measure(lambda: calls.append(time.sleep(.001)), warmup=1, repeats=3)
+    assert len(calls) == 4
+    assert .001 <= seconds < 1
+
+
+def test_compare():
+    baseline = {"results": {"fast": result(1.0, "ms"),
+                            "slow": result(1.0, "ms"),
+                            "rate": result(10.0, "positions/s", higher_is_better=True),
+                            "gone": result(1.0, "ms")}}
+    current = {"results": {"fast": result(.5, "ms"),
+                           "slow": result(1.5, "ms"),
+                           "rate": result(5.0, "positions/s", higher_is_better=True),
+                           "new": result(1.0, "ms")}}
+    assert compare(baseline, current, .1) == ["rate", "slow"]
+    assert compare(baseline, current, .6) == []
+
+
+def test_bench_qp(monkeypatch):
+    monkeypatch.setattr(benchmarks, "QP_BATCH_SIZES", [1, 2])
+    metaqp = SimpleNamespace(
+        qp=QP(), cuda=False,
+        wrap_to_variable=lambda array: torch.from_numpy(array.astype("float32")))
+
+    results = bench_qp(metaqp)
+    assert len(results) == 8
+    assert all(entry["value"] > 0 for entry in results.values())
+
@@ -0,0 +1,50 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+import config
+from compiled import compile_qp, fold_batchnorm
+
+
+def randomize_batchnorms(qp):
+    # fresh batchnorms are the identity in eval mode, which folds trivially
+    for module in qp.modules():
+        if isinstance(module, (nn.BatchNorm1d, nn.BatchNorm2d)):
+            module.running_mean.uniform_(-1, 1)
+            module.running_var.uniform_(.5, 2)
+            module.weight.data.uniform_(.5, 2)
+            module.bias.data.uniform_(-1, 1)
+    return qp
+
+
+def test_fold_batchnorm():
+    conv = nn.Conv2d(3, 4, kernel_size=1)
+    bn = randomize_batchnorms(nn.BatchNorm2d(4)).eval()
+    x = torch.randn(5, 3, 2, 2)
+    with torch.no_grad():
+        assert torch.allclose(fold_batchnorm(conv, bn)(x), bn(conv(x)), atol=1e-5)
+
+
+def test_compiled_matches_eager():
+    from models import QP
+
+    torch.manual_seed(0)
+    qp = randomize_batchnorms(QP()).eval()
+    compiled = compile_qp(qp)
+    states = torch.from_numpy(np.random.RandomState(0).randint(
+        0, 2, size=(7,) + config.SHAPE).astype("float32"))
+    policies = torch.softmax(torch.randn(7, config.R*config.C), 1)
+
+    with torch.no_grad():
+        Q, policy = qp(states)
+        compiled_Q, compiled_policy = compiled(states)
+        assert torch.allclose(policy, compiled_policy, atol=1e-5)
+        assert torch.allclose(Q, compiled_Q, atol=1e-5)
+
+        # the Q path of a given policy, through the split calls
+        Q, _ = qp(states, policies)
+        state_out = compiled.embed(states)
+        assert torch.allclose(Q, compiled.q(state_out, policies), atol=1e-5)
+        index = torch.LongTensor([6, 0, 0])
+        assert torch.allclose(Q[index], compiled.q(compiled.select(state_out, index),
+                                                   policies[index]), atol=1e-5)
@@ -0,0 +1,52 @@
+import numpy as np
+
+from Connect4 import BatchedConnect4, BitboardConnect4, mirror_states
+
+
+def test_zobrist_pairs_follow_batched_step():
+    connect4 = BitboardConnect4()
+    batched = BatchedConnect4()
+    zobrist = batched.zobrist
+    np.random.seed(0)
+
+    states = np.zeros((30, 3, 6, 7), dtype="float32")
+    states[::2, 2] = 1
+    heights = batched.get_heights(states)
+    pairs = zobrist.hash_pairs(states)
+    assert (pairs[:, 0] == pairs[:, 1]).all()
+
+    done = np.zeros(len(states), dtype=bool)
+    while not done.all():
+        active = np.flatnonzero(~done)
+        actions = [np.random.choice(connect4.get_legal_actions(states[k][:2]))
+                   for k in active]
+        single = zobrist.update_pairs(pairs[active[0]], int(states[active[0], 2, 0, 0]),
+                                      actions[0])
+
+        _, _, game_over = batched.step(states, actions, active, heights, pairs)
+
+        assert (pairs == zobrist.hash_pairs(states)).all()
+        assert (pairs[:, 1] == zobrist.hash_batch(mirror_states(states))).all()
+        assert (single == pairs[active[0]]).all()
+        done[active[game_over]] = True
+
+
+def test_carried_bitboards_match_the_planes():
+    np.random.seed(1)
+    for connect4 in [BitboardConnect4(), BitboardConnect4(7, 8, 5)]:
+        for _ in range(20):
+            state = np.zeros((3, connect4.rows, connect4.columns), dtype="float32")
+            rebuilt = np.copy(state)
+            boards = connect4.get_boards(state)
+            game_over = False
+            while not game_over:
+                legal = connect4.get_legal_actions(state[:2], boards=boards)
+                assert legal == connect4.get_legal_actions(state[:2])
+                action = np.random.choice(legal)
+
+                state, result, game_over = connect4.transition_and_evaluate(
+                    state, action, boards=boards)
+                rebuilt, expected, _ = connect4.transition_and_evaluate(rebuilt, action)
+
+                assert boards == connect4.get_boards(state)
+                assert result == expected
@@ -0,0 +1,36 @@
+import math
+
+from gating import SPRT, threshold_decision
+
+
+def test_threshold_decision():
+    assert threshold_decision({"new": 12, "best": 10, "draw": 5}, 1.1) == "promote"
+    assert threshold_decision({"new": 10, "best": 12, "draw": 5}, 1.1) == "revert"
+    assert threshold_decision({"new": 10, "best": 10, "draw": 50}, 1.1) is None
+    assert threshold_decision({"new": 0, "best": 0, "draw": 0}, 1.1) is None
+
+
+def test_sprt_bounds():
+    sprt = SPRT(threshold=2, alpha=.05, beta=.1)
+    assert math.isclose(sprt.p0, 1 / 3) and math.isclose(sprt.p1, 2 / 3)
+    assert math.isclose(sprt.lower, math.log(.1 / .95))
+    assert math.isclose(sprt.upper, math.log(.9 / .05))
+    assert sprt.games() == 0 and sprt.llr() == 0 and sprt.decision() is None
+
+
+def test_sprt_decisions():
+    # every decisive game moves the llr by log 2 for t = 2, draws not at all
+    sprt = SPRT(threshold=2, alpha=.05, beta=.05)
+    sprt.update({"new": 4, "best": 0, "draw": 100})
+    assert math.isclose(sprt.llr(), 4 * math.log(2))
+    assert sprt.decision() is None and sprt.games() == 104
+    sprt.update({"new": 1, "best": 0, "draw": 0})
+    assert sprt.decision() == "promote"
+
+    sprt = SPRT(threshold=2, alpha=.05, beta=.05)
+    sprt.update({"new": 10, "best": 15, "draw": 0})
+    assert sprt.decision() == "revert"
+
+    sprt = SPRT(threshold=2, alpha=.05, beta=.05)
+    sprt.update({"new": 20, "best": 20, "draw": 0})
+    assert sprt.llr() == 0 and sprt.decision() is None
@@ -0,0 +1,554 @@
+"""Behaviour tests for self-play, gating and inference around MetaQP.
+
+    python -m pytest -q test_metaqp.py
+
+The metaqp fixture, see conftest.py, is a fresh MetaQP with untrained
+models and empty memories.
+"""
+import asyncio
+
+import numpy as np
+import pytest
+
+import config
+
+
+class FakeSession:
+    """Uniform policies and the same Q for every position."""
+    def __init__(self, q):
+        self.value = q
+
+    def embed(self, states, hashes=None):
+        return states
+
+    def policy(self, embedding):
+        return np.ones((len(embedding), config.R*config.C), dtype="float32")
+
+    def select(self, embedding, index):
+        return embedding[index]
+
+    def q(self, embedding, policies):
+        return np.full((len(embedding), 1), self.value, dtype="float32")
+
+    def __call__(self, states, policies=None, percent_random=None):
+        if policies is None:
+            policies = self.policy(states)
+        return self.q(states, policies), policies
+
+
+def fake_async_self_play(metaqp, q=0):
+    from scheduler import AsyncSelfPlay
+
+    self_play = AsyncSelfPlay(metaqp)
+    for dispatcher in self_play.dispatchers.values():
+        dispatcher.session = FakeSession(q)
+    return self_play
+
+
+def action(row, column):
+    return row*config.C + column
+
+
+def threat_position():
+    """Player 0 to move, with three in a row on the bottom row: column 3
+    wins on the spot, column 6 leaves the threat standing."""
+    state = np.zeros(config.SHAPE, dtype="float32")
+    bottom = config.R - 1
+    state[0][bottom, :3] = 1
+    state[1][bottom - 1, :3] = 1
+    return state
+
+
+def one_hot(move):
+    policy = np.zeros((1, config.R*config.C), dtype="float32")
+    policy[0, move] = 1
+    return policy
+
+
+def rollout_result(metaqp, move, starting_player):
+    state = threat_position()[None]
+    tasks = [{"starting_player": starting_player,
+              "memories": [{} for _ in range(config.N_WAY)]}]
+    metaqp.rollout_buffer.load(state, metaqp.get_heights(state), metaqp.get_hashes(state),
+                               one_hot(move), np.array([0]))
+    metaqp.rollout(tasks, best_player=0)
+    return tasks[0]["memories"][0]["result"]
+
+
+@pytest.mark.parametrize("starting_player", [0, 1])
+def test_truncated_rollout_matches_finished_sign(metaqp, monkeypatch, starting_player):
+    # after the quiet move player 1 is to move and lost, so its Q is -1
+    monkeypatch.setattr(metaqp, "inference_session", lambda best_player: FakeSession(-1))
+    metaqp.rollout_horizon = 1
+
+    finished = rollout_result(metaqp, action(config.R - 1, 3), starting_player)
+    truncated = rollout_result(metaqp, action(config.R - 1, 6), starting_player)
+    assert finished in (-1, 1)
+    assert truncated == finished
+
+
+@pytest.mark.parametrize("starting_player", [0, 1])
+def test_async_truncated_rollout_matches_finished_sign(metaqp, starting_player):
+    metaqp.self_play_model = "qp"
+    metaqp.rollout_horizon = 1
+    self_play = fake_async_self_play(metaqp, q=-1)
+
+    state = threat_position()
+    heights = metaqp.get_heights(state[None])[0]
+
+    def rollout(column):
+        self_play.running = 1
+        return asyncio.run(self_play.rollout(state, heights, one_hot(action(config.R - 1, column))[0],
+                                             starting_player, best_player=0))
+
+    finished, truncated = rollout(3), rollout(6)
+    assert finished in (-1, 1)
+    assert truncated == finished
+    assert finished == rollout_result(metaqp, action(config.R - 1, 3), starting_player)
+
+
+def test_sprt_gate_plays_evaluation_chunks(metaqp, monkeypatch):
+    import evaluation
+
+    chunks = []
+
+    def play(self, root_state):
+        chunks.append(root_state.shape)
+        return {"new": 3, "best": 0, "draw": 1}
+
+    monkeypatch.setattr(evaluation.Evaluator, "play", play)
+    monkeypatch.setattr(config, "SPRT_GATING", True)
+    root_state = np.zeros(config.SHAPE, dtype="float32")
+
+    # lopsided self-play results are never fed to the test
+    assert metaqp.gate(root_state, {"new": 0, "best": 500, "draw": 0}) == "promote"
+    # each chunk adds 3 log(t) to the llr, the upper bound is log 19
+    assert len(chunks) == int(np.ceil(np.log(19) / (3 * np.log(config.SCORING_THRESHOLD))))
+    assert set(chunks) == {config.SHAPE}
+
+    monkeypatch.setattr(config, "SPRT_GATING", False)
+    assert metaqp.gate(root_state, {"new": 0, "best": 500, "draw": 0}) == "revert"
+
+
+def serve_one_actor(target):
+    # runs target(channel) in a forked actor against a fresh QP
+    import multiprocessing
+    import torch
+    from actors import ActorChannel, InferenceServer
+    from models import QP
+
+    torch.manual_seed(0)
+    qp = QP().eval()
+    context = multiprocessing.get_context("fork")
+    requests = context.Queue()
+    outputs = context.Queue()
+    channel = ActorChannel(0, requests, context)
+    actor = context.Process(target=target, args=(channel, outputs))
+    actor.start()
+
+    server = InferenceServer({"qp": qp}, [channel], requests)
+    try:
+        server.serve([actor])
+        return qp, server, outputs.get(timeout=10)
+    finally:
+        actor.join(timeout=10)
+
+
+def random_states(num_states):
+    return np.random.RandomState(0).randint(
+        0, 2, size=(num_states,) + config.SHAPE).astype("float32")
+
+
+def test_actor_server_request_kinds():
+    import torch
+    from actors import RemoteQP
+    from inference import InferenceSession
+
+    states = random_states(5)
+    policies = np.full((5, config.R*config.C), 1 / (config.R*config.C), dtype="float32")
+
+    def actor(channel, outputs):
+        remote = RemoteQP(channel, "qp")
+        state = torch.from_numpy(states)
+        policy = remote.policy(remote.embed(state))
+        Q = remote.q(remote.embed(state), torch.from_numpy(policies))
+        forward_Q, forward_policy = remote(state)
+        outputs.put([output.data.numpy() for output in [policy, Q, forward_Q, forward_policy]])
+        channel.done()
+
+    qp, server, (policy, Q, forward_Q, forward_policy) = serve_one_actor(actor)
+
+    session = InferenceSession(qp)
+    expected_Q, expected_policy = session(states)
+    assert np.allclose(policy, expected_policy, atol=1e-6)
+    assert np.allclose(forward_policy, expected_policy, atol=1e-6)
+    assert np.allclose(forward_Q, expected_Q, atol=1e-6)
+    assert np.allclose(Q, session(states, policies)[0], atol=1e-6)
+    assert server.batch_sizes == [5, 5, 5]
+
+
+def test_actor_server_keeps_the_policy_embedding_for_q(monkeypatch):
+    import torch
+    from actors import RemoteQP
+    from inference import InferenceSession
+    from models import QP
+
+    states = random_states(5)
+    index = np.array([4, 4, 0, 2])
+    policies = np.random.RandomState(1).dirichlet(
+        [1] * config.R*config.C, size=len(index)).astype("float32")
+
+    def actor(channel, outputs):
+        remote = RemoteQP(channel, "qp")
+        embedding = remote.embed(torch.from_numpy(states))
+        remote.policy(embedding)
+        selected = remote.select(embedding, torch.from_numpy(index))
+        Q = remote.q(remote.select(selected, torch.tensor([3, 0, 1])),
+                     torch.from_numpy(policies[[3, 0, 1]]))
+        outputs.put(Q.data.numpy())
+        channel.done()
+
+    embeds = []
+    embed = QP.embed
+    monkeypatch.setattr(QP, "embed", lambda self, state: embeds.append(len(state)) or
+                        embed(self, state))
+    qp, server, Q = serve_one_actor(actor)
+
+    # the trunk ran for the POLICY request only
+    assert embeds == [5]
+    assert server.batch_sizes == [5, 3]
+    monkeypatch.setattr(QP, "embed", embed)
+    session = InferenceSession(qp)
+    assert np.allclose(Q, session(states[index[[3, 0, 1]]], policies[[3, 0, 1]])[0],
+                       atol=1e-6)
+    assert server.embeddings == {}
+
+
+def test_actor_server_raises_when_an_actor_dies():
+    def actor(channel, outputs):
+        raise ValueError("actor crashed before its DONE")
+
+    with pytest.raises(RuntimeError):
+        serve_one_actor(actor)
+
+
+def test_dispatcher_flushes_once_every_coroutine_waits(metaqp):
+    self_play = fake_async_self_play(metaqp)
+    dispatchers = self_play.dispatchers
+    states = random_states(4)
+
+    async def request(name, rows):
+        await dispatchers[name].policy(states[:rows])
+        self_play.stopped()
+
+    async def run():
+        self_play.running = 4
+        await asyncio.gather(request("qp", 1), request("best", 2),
+                             request("qp", 3), request("best", 4))
+
+    asyncio.run(run())
+    assert dispatchers["qp"].batch_sizes == [4]
+    assert dispatchers["best"].batch_sizes == [6]
+
+
+def test_dispatcher_without_deadline_runs_partial_batches():
+    from scheduler import BatchingDispatcher
+
+    dispatcher = BatchingDispatcher(FakeSession(0), batch_size=4, deadline=None)
+    policies = asyncio.run(dispatcher.policy(random_states(3)))
+    assert policies.shape == (3, config.R*config.C)
+    assert dispatcher.batch_sizes == [3]
+
+def test_async_self_play_finishes_every_game(metaqp, monkeypatch):
+    monkeypatch.setattr(config, "ASYNC_GAMES_IN_FLIGHT", 3)
+    self_play = fake_async_self_play(metaqp)
+
+    results = asyncio.run(self_play.play(np.zeros(config.SHAPE, dtype="float32"), 5))
+    assert sum(results.values()) == 5
+    assert self_play.running == 0
+    assert all(len(task["memories"]) == config.N_WAY for task in metaqp.memories)
+    # every candidate gets its own noise draw
+    candidates = np.array([memory["policy"] for memory in metaqp.memories[0]["memories"]])
+    assert len(np.unique(candidates, axis=0)) == config.N_WAY
+    batch_sizes = [size for dispatcher in self_play.dispatchers.values()
+                   for size in dispatcher.batch_sizes]
+    assert max(batch_sizes) > config.N_WAY
+
+
+def cached_session(metaqp, monkeypatch):
+    from inference import InferenceCache, InferenceSession
+
+    monkeypatch.setattr(config, "INFERENCE_CACHE_SIZE", 100)
+    # compared against the plain model below, so no mirror canonicalisation
+    monkeypatch.setattr(config, "CANONICAL_INFERENCE", False)
+    metaqp.inference_cache = InferenceCache(100)
+    return InferenceSession(metaqp.inference_model(metaqp.qp))
+
+
+def test_inference_cache_hit_matches_miss(metaqp, monkeypatch):
+    from inference import InferenceSession
+
+    states = random_states(4)
+    states[3] = states[0]
+    policies = np.random.RandomState(1).dirichlet(
+        [1] * config.R*config.C, size=4).astype("float32")
+    session = cached_session(metaqp, monkeypatch)
+    cache = metaqp.inference_cache
+
+    missed = session.policy(session.embed(states))
+    hits = cache.hits
+    hit = session.policy(session.embed(states))
+    assert cache.misses and cache.hits > hits
+    assert np.array_equal(hit, missed)
+    assert np.array_equal(session.q(session.embed(states), policies),
+                          session.q(session.embed(states), policies))
+
+    uncached = InferenceSession(metaqp.qp)
+    assert np.allclose(hit, uncached.policy(uncached.embed(states)), atol=1e-6)
+    assert np.allclose(session(states, policies)[0], uncached(states, policies)[0], atol=1e-6)
+
+
+def test_weight_change_invalidates_inference_cache(metaqp, monkeypatch):
+    import torch
+    from inference import InferenceSession
+
+    states = random_states(4)
+    session = cached_session(metaqp, monkeypatch)
+    stale = session.policy(session.embed(states))
+
+    with torch.no_grad():
+        for parameter in metaqp.qp.parameters():
+            parameter.add_(.01)
+    metaqp.weights_changed("qp")
+    session = InferenceSession(metaqp.inference_model(metaqp.qp))
+    hits = metaqp.inference_cache.hits
+    fresh = session.policy(session.embed(states))
+
+    assert metaqp.inference_cache.hits == hits
+    assert not np.allclose(fresh, stale)
+    uncached = InferenceSession(metaqp.qp)
+    assert np.allclose(fresh, uncached.policy(uncached.embed(states)), atol=1e-6)
+    # best_qp kept its version
+    assert metaqp.model_version(metaqp.best_qp) != metaqp.model_version(metaqp.qp)
+
+
+def test_correct_policies_falls_back_to_uniform_legal(metaqp):
+    states = np.zeros((2,) + config.SHAPE, dtype="float32")
+    states[:, 0, :, 0] = 1
+    heights = metaqp.get_heights(states)
+    policies = np.zeros((2, config.R*config.C), dtype="float32")
+    # all of the first row's mass sits on the full column
+    policies[0, action(0, 0)] = 1
+    policies[1, action(config.R - 1, 1)] = 1
+
+    corrected = metaqp.correct_policies(policies, states, heights)
+    legal = metaqp.legal_mask(states, heights)[0]
+    assert np.allclose(corrected[0][legal], 1 / (config.C - 1))
+    assert not corrected[0][~legal].any()
+    assert corrected[1, action(config.R - 1, 1)] == 1
+
+    # the same in place
+    assert metaqp.correct_policies(policies, states, heights, out=policies) is policies
+    assert np.array_equal(policies, corrected)
+
+
+def test_sample_actions_needs_probability_mass(metaqp):
+    policies = np.zeros((3, config.R*config.C), dtype="float32")
+    policies[:, [5, 9]] = .5
+    assert set(metaqp.sample_actions(np.repeat(policies, 100, axis=0))) == {5, 9}
+
+    policies[1] = 0
+    with pytest.raises(AssertionError):
+        metaqp.sample_actions(policies)
+
+
+@pytest.mark.parametrize("best_player", [0, 1])
+def test_dual_qp_rows_keep_their_owner(best_player):
+    import torch
+    from inference import DualQP, InferenceSession, model_pool
+    from models import QP
+
+    torch.manual_seed(0)
+    qp, best_qp = QP().eval(), QP().eval()
+    states = random_states(6)
+    players = np.array([0, 1, 1, 0, 1, 0])
+    states[:, 2] = players[:, None, None]
+    policies = np.random.RandomState(1).dirichlet(
+        [1] * config.R*config.C, size=6).astype("float32")
+
+    dual = InferenceSession(DualQP(qp, best_qp, best_player, model_pool(1)))
+    sessions = [InferenceSession(qp), InferenceSession(best_qp)]
+    owners = (players == best_player).astype("int64")
+
+    def expected(call):
+        # each row as its owner computes it on its own
+        return np.concatenate([call(sessions[owner], states[[k]])
+                               for k, owner in enumerate(owners)])
+
+    embedding = dual.embed(states)
+    # the models disagree, so a row routed to the wrong one shows
+    assert not np.allclose(sessions[0].policy(sessions[0].embed(states)),
+                           sessions[1].policy(sessions[1].embed(states)), atol=1e-6)
+    assert np.allclose(dual.policy(embedding),
+                       expected(lambda session, state: session.policy(session.embed(state))),
+                       atol=1e-6)
+    assert np.allclose(dual(states, policies)[0],
+                       np.concatenate([sessions[owner](states[[k]], policies[[k]])[0]
+                                       for k, owner in enumerate(owners)]), atol=1e-6)
+
+    # select keeps the owner of every picked row
+    index = np.array([5, 0, 2, 2])
+    selected = dual.q(dual.select(embedding, index), policies[index])
+    assert np.allclose(selected,
+                       np.concatenate([sessions[owners[k]].q(sessions[owners[k]].embed(states[[k]]),
+                                                             policies[[k]])
+                                       for k in index]), atol=1e-6)
+
+
+def test_evaluator_is_deterministic(metaqp):
+    from evaluation import Evaluator
+
+    root_state = np.zeros(config.SHAPE, dtype="float32")
+    first, second = Evaluator(metaqp, batch_size=4), Evaluator(metaqp, batch_size=4)
+    assert np.array_equal(first.openings(root_state, 4), second.openings(root_state, 4))
+
+    results = first.play(root_state)
+    assert results == second.play(root_state)
+    assert sum(results.values()) == 4
+
+    # the next chunk plays new openings
+    fresh = Evaluator(metaqp, batch_size=4)
+    assert not np.array_equal(first.openings(root_state, 4), fresh.openings(root_state, 4))
+
+
+def test_qp_split_calls_match_forward():
+    import torch
+    from models import QP
+
+    torch.manual_seed(0)
+    qp = QP().eval()
+    states = torch.from_numpy(random_states(3))
+    policies = torch.from_numpy(np.random.RandomState(1).dirichlet(
+        [1] * config.R*config.C, size=3).astype("float32"))
+
+    with torch.no_grad():
+        Q, policy = qp(states)
+        embedding = qp.embed(states)
+        assert torch.allclose(qp.policy(embedding), policy, atol=1e-6)
+        assert torch.allclose(qp.q(embedding, policy), Q, atol=1e-6)
+        # one trunk pass serves several Q queries, also on repeated rows
+        index = torch.LongTensor([2, 2, 0])
+        assert torch.allclose(qp.q(qp.select(embedding, index), policies[index]),
+                              qp(states[index], policies[index])[0], atol=1e-6)
+
+
+def test_candidate_policies_share_one_evaluation_per_task(metaqp):
+    from inference import InferenceSession
+
+    session = InferenceSession(metaqp.qp)
+    task_states = random_states(2)
+    candidates, embedding = metaqp.candidate_policies(session, task_states, percent_random=.2)
+
+    assert candidates.shape == (2*config.N_WAY, config.R*config.C)
+    policy = session.policy(session.embed(task_states))
+    for task_idx in range(2):
+        rows = candidates[task_idx*config.N_WAY:(task_idx+1)*config.N_WAY]
+        # each candidate is the task policy with its own noise mixed in
+        assert len(np.unique(rows, axis=0)) == config.N_WAY
+        assert np.all(np.abs(rows - .8*policy[task_idx]) <= .2 + 1e-6)
+    # the embeddings line up with the candidates
+    repeated = np.repeat(task_states, config.N_WAY, axis=0)
+    assert np.allclose(session.q(embedding, candidates), session(repeated, candidates)[0],
+                       atol=1e-6)
+
+
+def test_play_stream_refills_finished_slots(metaqp, monkeypatch):
+    monkeypatch.setattr(metaqp, "inference_session", lambda best_player: FakeSession(0))
+    num_tasks = config.EPISODE_BATCH_SIZE // config.N_WAY
+
+    results = metaqp.play_stream(np.zeros(config.SHAPE, dtype="float32"),
+                                 num_games=2*config.EPISODE_BATCH_SIZE)
+    # more games than one minibatch holds, so slots were restarted
+    assert sum(results.values()) >= 2*config.EPISODE_BATCH_SIZE
+    assert len(metaqp.memories) > num_tasks
+
+
+def test_inference_session_matches_autograd_path():
+    import torch
+    from inference import InferenceSession
+    from models import QP
+
+    torch.manual_seed(0)
+    qp = QP().eval()
+    states = random_states(3)
+    policies = np.random.RandomState(1).dirichlet(
+        [1] * config.R*config.C, size=3).astype("float32")
+    session = InferenceSession(qp)
+
+    Q, policy = session(states)
+    assert isinstance(Q, np.ndarray) and isinstance(policy, np.ndarray)
+    expected_Q, expected_policy = qp(torch.from_numpy(states))
+    assert expected_Q.requires_grad
+    assert np.allclose(Q, expected_Q.data.numpy(), atol=1e-6)
+    assert np.allclose(policy, expected_policy.data.numpy(), atol=1e-6)
+    assert np.allclose(session.q(session.embed(states), policies),
+                       qp(torch.from_numpy(states), torch.from_numpy(policies))[0].data.numpy(),
+                       atol=1e-6)
+
+
+def test_symmetric_qp_canonicalizes_by_carried_hashes():
+    import torch
+    from Connect4 import ZobristHash, mirror_actions, mirror_states
+    from inference import InferenceSession, SymmetricQP
+    from models import QP
+
+    torch.manual_seed(0)
+    qp = QP().eval()
+    states = random_states(6)
+    states[4] = mirror_states(states[0])
+    states[5] = states[1]
+    hashes = ZobristHash(config.R, config.C).hash_pairs(states)
+
+    symmetric = InferenceSession(SymmetricQP(qp))
+    embedding = symmetric.embed(states, hashes)
+    # a state, its mirror and its duplicate run through the trunk once
+    assert len(embedding.embedding.state_out) == 4
+    policy = symmetric.policy(embedding)
+
+    # each row is evaluated in the orientation with the smaller hash
+    plain = InferenceSession(qp)
+    mirror = mirror_actions(config.R, config.C)
+    for state, (hashed, mirror_hashed), row in zip(states, hashes, policy):
+        if mirror_hashed < hashed:
+            expected = plain.policy(plain.embed(np.ascontiguousarray(mirror_states(state[None]))))[0][mirror]
+        else:
+            expected = plain.policy(plain.embed(state[None]))[0]
+        assert np.allclose(row, expected, atol=1e-6)
+    assert np.allclose(policy[4], policy[0][mirror], atol=1e-6)
+
+
+def test_self_play_keys_the_cache_on_carried_hashes(metaqp, monkeypatch):
+    from inference import InferenceCache
+
+    monkeypatch.setattr(config, "INFERENCE_CACHE_SIZE", 10000)
+    metaqp.inference_cache = InferenceCache(10000)
+    num_tasks = config.EPISODE_BATCH_SIZE // config.N_WAY
+    starting_player_list = [task_idx % 2 for task_idx in range(num_tasks)]
+    states = np.zeros((num_tasks,) + config.SHAPE, dtype="float32")
+    states[:, 2] = np.array(starting_player_list)[:, None, None]
+    heights, hashes = metaqp.get_heights(states), metaqp.get_hashes(states)
+
+    def hash_batch(states):
+        raise AssertionError("rehashed {} boards".format(len(states)))
+
+    monkeypatch.setattr(metaqp.zobrist, "hash_batch", hash_batch)
+    episode = (list(states), heights, hashes, [False] * config.EPISODE_BATCH_SIZE, 0,
+               {"new": 0, "best": 0, "draw": 0})
+    # the task states of the second move were reached by first move rollouts
+    for _ in range(2):
+        episode = metaqp.meta_self_play(*episode, 0, starting_player_list)
+    monkeypatch.undo()
+
+    assert metaqp.inference_cache.hits
+    next_states, _, next_hashes = episode[:3]
+    assert np.array_equal(next_hashes, metaqp.get_hashes(np.array(next_states)))
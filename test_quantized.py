@@ -0,0 +1,92 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+import config
+from quantized import QuantizedQP, accuracy, quantize_qp
+
+
+def random_states(num_states, seed=0):
+    # positions of random games, as calibration and test input
+    from Connect4 import BitboardConnect4
+
+    rng = np.random.RandomState(seed)
+    connect4 = BitboardConnect4(config.R, config.C, config.N_IN_A_ROW)
+    states = []
+    while len(states) < num_states:
+        state = np.zeros(config.SHAPE, dtype="float32")
+        game_over = False
+        while not game_over and len(states) < num_states:
+            states.append(np.copy(state))
+            action = rng.choice(connect4.get_legal_actions(state[:2]))
+            state, _, game_over = connect4.transition_and_evaluate(state, action)
+    return np.array(states)
+
+
+def test_quantize_qp():
+    from models import QP
+
+    torch.manual_seed(0)
+    qp = QP().eval()
+    quantized = quantize_qp(qp, random_states(120))
+    errors = accuracy(qp, quantized, random_states(60, seed=1))
+    assert errors["policy_kl"] < 1e-3
+    assert errors["q_mae"] < 1e-2
+
+
+def test_quantized_qp_batch_size():
+    calls = []
+
+    class Recorder:
+        def __init__(self, name):
+            self.name = name
+
+        def embed(self, state):
+            calls.append(self.name)
+            return state
+
+        def policy(self, state_out):
+            calls.append(self.name)
+            return torch.ones(len(state_out), config.R*config.C) / (config.R*config.C)
+
+        def q(self, state_out, policy):
+            calls.append(self.name)
+            return torch.zeros(len(state_out), 1)
+
+    qp = QuantizedQP(Recorder("int8"), Recorder("float"), min_batch=4)
+    qp(torch.zeros((3,) + config.SHAPE))
+    assert calls == ["float"] * 3
+    del calls[:]
+    Q, policy = qp(torch.zeros((4,) + config.SHAPE), percent_random=.2)
+    assert calls == ["int8"] * 3
+    # the noise goes on top of whichever copy ran
+    assert not torch.allclose(policy, torch.ones(4, config.R*config.C) / (config.R*config.C))
+
+
+def test_quantized_inference_needs_cpu():
+    from MetaQP import MetaQP
+
+    metaqp = SimpleNamespace(compiled_inference=False, quantized_inference=True, cuda=True)
+    with pytest.raises(ValueError):
+        MetaQP.compiled_model(metaqp, object())
+
+
+def test_default_self_play_reaches_int8(metaqp, monkeypatch):
+    # QuantizedQP sits below the SymmetricQP and DualQP splits, but picks
+    # by the rows of the whole session call
+    monkeypatch.setattr(metaqp, "quantized_inference", True)
+    monkeypatch.setattr(metaqp, "calibration_states", lambda: random_states(120))
+    num_tasks = config.EPISODE_BATCH_SIZE // config.N_WAY
+    starting_player_list = [task_idx % 2 for task_idx in range(num_tasks)]
+    states = np.zeros((num_tasks,) + config.SHAPE, dtype="float32")
+    states[:, 2] = np.array(starting_player_list)[:, None, None]
+
+    metaqp.meta_self_play(list(states), metaqp.get_heights(states), metaqp.get_hashes(states),
+                          [False] * config.EPISODE_BATCH_SIZE, 0,
+                          {"new": 0, "best": 0, "draw": 0}, 0, starting_player_list)
+
+    models = list(metaqp.compiled_models.values())
+    assert len(models) == 2 and all(isinstance(model, QuantizedQP) for model in models)
+    assert all(model.calls["int8"] and model.calls["float"] for model in models)
@@ -0,0 +1,43 @@
+import numpy as np
+
+import config
+from rollout_buffer import RolloutBuffer
+
+
+def fill(num_rows):
+    states = np.arange(num_rows, dtype="float32")[:, None, None, None] * np.ones(
+        (1, config.CH, config.R, config.C), dtype="float32")
+    heights = np.arange(num_rows)[:, None] * np.ones((1, config.C), dtype="int64")
+    hashes = np.arange(num_rows, dtype="uint64")[:, None] * np.ones((1, 2), dtype="uint64")
+    policies = np.arange(num_rows, dtype="float32")[:, None] * np.ones(
+        (1, config.R*config.C), dtype="float32")
+    return states, heights, hashes, policies
+
+
+def test_remove_keeps_live_rows_packed():
+    buffer = RolloutBuffer(capacity=8)
+    buffer.load(*fill(8), np.array([1, 2, 3, 5, 6, 7]))
+
+    buffer.remove(np.array([True, False, True, False, False, True]))
+    live_states, live_heights, live_hashes, live_policies, rows = buffer.live()
+    assert len(buffer) == 3
+    assert sorted(rows) == [2, 5, 6]
+    # every slot still holds the data of the row it points back to
+    assert np.array_equal(live_states[:, 0, 0, 0], rows)
+    assert np.array_equal(live_heights[:, 0], rows)
+    assert np.array_equal(live_hashes[:, 1], rows)
+    assert np.array_equal(live_policies[:, 0], rows)
+
+    buffer.remove(rows == 5)
+    assert sorted(buffer.live()[4]) == [2, 6]
+    buffer.remove(np.ones(2, dtype=bool))
+    assert len(buffer) == 0
+
+
+def test_live_is_a_view():
+    buffer = RolloutBuffer(capacity=4)
+    buffer.load(*fill(4), np.arange(4))
+    states = buffer.live()[0]
+    states += 1
+    assert np.shares_memory(states, buffer.states)
+    assert buffer.states[0, 0, 0, 0] == 1
@@ -0,0 +1,54 @@
+from collections import OrderedDict
+
+import config
+
+
+class TranspositionTable:
+    """Bounded position table keyed by Zobrist hash.
+
+    Lookups and inserts are O(1) dict operations on the integer hash. Once
+    max_size entries are stored the least recently used one is evicted, so
+    a single table can be shared by the search and the inference caches
+    without growing without bound.
+    """
+    def __init__(self, max_size=config.TRANSPOSITION_TABLE_SIZE):
+        self.max_size = max_size
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, key):
+        return key in self.table
+
+    def get(self, key, default=None):
+        try:
+            value = self.table[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.table.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.table[key] = value
+        self.table.move_to_end(key)
+        if len(self.table) > self.max_size:
+            self.table.popitem(last=False)
+
+    def clear(self):
+        self.table.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0
+        return self.hits / lookups
@@ -1,17 +1,58 @@
-from MCTSnet import MCTSnet
-from Connect4 import Connect4
+from Connect4 import BitboardConnect4
+from inference import InferenceSession
+import model_utils
 import config
 import numpy as np
 
-connect4 = Connect4()
-actions = connect4.actions
-calculate_reward = connect4.calculate_reward
-get_legal_actions = connect4.get_legal_actions
-transition = connect4.transition
+connect4 = BitboardConnect4(config.R, config.C, config.N_IN_A_ROW)
 
-root_state = np.zeros(shape=(6, 7))
+# the best checkpoint, playing the greedy move of its policy
+session = InferenceSession(model_utils.load_model())
 
-mcts_net = MCTSnet(actions=actions, calculate_reward=calculate_reward,
-            get_legal_actions=get_legal_actions, transition=transition)
 
-mcts_net.play_cpu(root_state)
\ No newline at end of file
+def show(state):
+    board = np.full((config.R, config.C), "_", dtype=object)
+    board[state[0] > 0] = "O"
+    board[state[1] > 0] = "X"
+    print(board)
+
+
+def choose_column(columns):
+    while True:
+        try:
+            column = int(input("Pick a column (1-{}): ".format(config.C))) - 1
+        except ValueError:
+            column = -1
+        if column in columns:
+            return column
+        print("Invalid choice.")
+
+
+state = np.zeros(config.SHAPE, dtype="float32")
+heights = np.zeros(config.C, dtype="int64")
+np.set_printoptions(precision=3)
+
+game_over = False
+while not game_over:
+    legal_actions = connect4.get_legal_actions(state[:2], heights)
+    player = int(state[2][0][0])
+    if player == 0:
+        show(state)
+        columns = {action % config.C: action for action in legal_actions}
+        action = columns[choose_column(columns)]
+    else:
+        _, policy = session(state[None])
+        print(policy[0].reshape(config.R, config.C))
+        legal_policy = np.full(len(connect4.actions), -1.0)
+        legal_policy[legal_actions] = policy[0][legal_actions]
+        action = int(np.argmax(legal_policy))
+
+    state, reward, game_over = connect4.transition_and_evaluate(state, action, heights)
+
+show(state)
+if reward == 0:
+    print("Draw")
+elif player == 0:
+    print("You win")
+else:
+    print("CPU wins")